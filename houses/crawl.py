@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import os
+import json
+import math
+import time
+import queue
+import itertools
+import threading
+from dataclasses import dataclass, asdict
+import logging as l
+
+from schema import get_db
+
+
+ZILLOW_URL = 'https://www.zillow.com/homes/for_sale'
+
+# the most homes a map search returns, denser tiles get split
+RESULT_CAP = 500
+MAX_DEPTH = 4
+DRIVERS = 2
+SEARCH_TIMEOUT = 30
+# seconds between searches of one driver, so it doesn't look automated
+SEARCH_DELAY = 2
+
+
+@dataclass
+class Tile:
+  west: float
+  east: float
+  south: float
+  north: float
+  depth: int = 0
+
+  def bounds(self) -> dict[str, float]:
+    return {k: v for k, v in asdict(self).items() if k != 'depth'}
+
+  def zoom(self) -> int:
+    # map zoom whose viewport about fits the tile
+    return min(18, int(math.log2(360 / (self.east - self.west))) + 2)
+
+  def split(self) -> list['Tile']:
+    '''quadrants of the tile'''
+    lng = (self.west + self.east) / 2
+    lat = (self.south + self.north) / 2
+    return [
+        Tile(w, e, s, n, self.depth + 1)
+        for w, e in ((self.west, lng), (lng, self.east))
+        for s, n in ((self.south, lat), (lat, self.north))]
+
+
+def grid(tile, n) -> list[Tile]:
+  '''split `tile` into n x n tiles'''
+  dx = (tile.east - tile.west) / n
+  dy = (tile.north - tile.south) / n
+  return [
+      Tile(tile.west + i * dx, tile.west + (i + 1) * dx,
+        tile.south + j * dy, tile.south + (j + 1) * dy)
+      for i in range(n) for j in range(n)]
+
+
+def search_url(tile) -> str:
+  # any type of automated activity on the page seems to cause bot detection
+  # so put search query in URL
+  search_query = {
+    'mapBounds': tile.bounds(),
+    'isMapVisible': True,
+    'filterState': {
+      'sort': { 'value': 'globalrelevanceex' },
+      'ah': { 'value': True }
+    },
+    'isListVisible': True,
+    'mapZoom': tile.zoom(),
+  }
+  return f'{ZILLOW_URL}/?searchQueryState={json.dumps(search_query)}'
+
+
+def is_truncated(body) -> bool:
+  '''check if the search found more homes than it returned'''
+  res = body['cat1']['searchResults']['mapResults']
+  total = body['cat1'].get('searchList', {}).get('totalResultCount', len(res))
+  return total > len(res) or len(res) >= RESULT_CAP
+
+
+class Driver:
+  '''browser reused across searches, capturing the search response of each
+  page it loads'''
+  def __init__(self):
+    # not needed to ingest captured responses
+    import undetected_chromedriver as uc
+    self.driver = uc.Chrome(enable_cdp_events=True)
+    self.driver.add_cdp_listener('Network.requestWillBeSent', self.request_sent)
+    self.driver.add_cdp_listener('Network.responseReceived', self.response_received)
+    self.body = None
+    self.loaded = threading.Event()
+    # search requests made by the page of the current search, responses to
+    # any others are late ones for a search that timed out
+    self.requests = set()
+    self.lock = threading.Lock()
+
+  def request_sent(self, e):
+    try:
+      if 'GetSearchPageState.htm' in e['params']['request']['url']:
+        with self.lock:
+          self.requests.add(e['params']['requestId'])
+    except Exception as e:
+      l.error(f'Failed to track search request: {e}')
+
+  def response_received(self, e):
+    # runs on the driver's event thread, only hands the body over
+    try:
+      req_url = e['params']['response']['url']
+      if not 'GetSearchPageState.htm' in req_url:
+        return
+      with self.lock:
+        if self.loaded.is_set() or e['params']['requestId'] not in self.requests:
+          return
+
+      resp = self.driver.execute_cdp_cmd('Network.getResponseBody', {
+        'requestId': e['params']['requestId']
+        })
+      with self.lock:
+        if self.loaded.is_set() or e['params']['requestId'] not in self.requests:
+          return
+        self.body = resp['body']
+        self.loaded.set()
+    except Exception as e:
+      l.error(f'Failed to get search response: {e}')
+
+  def search(self, tile):
+    '''load the map search for `tile`, returns its raw response'''
+    with self.lock:
+      self.body = None
+      self.requests.clear()
+      self.loaded.clear()
+    self.driver.get(search_url(tile))
+    if not self.loaded.wait(SEARCH_TIMEOUT):
+      with self.lock:
+        # ignore the response if it still comes
+        self.requests.clear()
+      raise TimeoutError(f'no search response after {SEARCH_TIMEOUT}s')
+    return self.body
+
+  def quit(self):
+    self.driver.quit()
+
+
+capture_count = itertools.count()
+
+
+def capture_response(capture, raw):
+  '''save a raw search response to directory `capture`, for `ingest`'''
+  path = os.path.join(capture,
+      f'{time.strftime("%Y%m%d-%H%M%S")}-{next(capture_count):05d}.json')
+  with open(path, 'w') as f:
+    f.write(raw)
+
+
+def crawl_tiles(driver, tiles, results, capture=None):
+  '''search tiles from the queue until given None, splitting any with more
+  homes than a search returns'''
+  while (tile := tiles.get()) is not None:
+    try:
+      raw = driver.search(tile)
+      if capture:
+        capture_response(capture, raw)
+      body = json.loads(raw)
+      if is_truncated(body) and tile.depth < MAX_DEPTH:
+        l.info(f'Tile {tile} is truncated, splitting...')
+        for t in tile.split():
+          tiles.put(t)
+      results.put(body)
+    except Exception as e:
+      l.error(f'Failed to search tile {tile}: {e}')
+    finally:
+      tiles.task_done()
+    time.sleep(SEARCH_DELAY)
+
+
+def write_results(results, save, opened):
+  '''save search responses from the queue until given None, skipping homes
+  already saved from an overlapping tile. puts None to `opened` once the db
+  is open, or the error opening it'''
+  try:
+    conn, c = get_db()
+  except Exception as e:
+    opened.put(e)
+    return
+  opened.put(None)
+  seen = set()
+  while (body := results.get()) is not None:
+    res = [r for r in body['cat1']['searchResults']['mapResults']
+        if r.get('zpid') not in seen]
+    try:
+      save(conn, c, res)
+    except Exception as e:
+      l.error(f'Failed to save {len(res)} results: {e}')
+    else:
+      # only once saved, overlapping tiles get another chance otherwise
+      seen.update(r.get('zpid') for r in res)
+  conn.close()
+  l.info(f'Saved {len(seen)} homes')
+
+
+def crawl(tiles, save, drivers=DRIVERS, capture=None):
+  '''search all `tiles` on a pool of browsers, passing new results to
+  `save(conn, c, results)` on a writer thread'''
+  if capture:
+    os.makedirs(capture, exist_ok=True)
+  tile_queue, results = queue.Queue(), queue.Queue()
+  for t in tiles:
+    tile_queue.put(t)
+
+  opened = queue.Queue()
+  writer = threading.Thread(target=write_results, args=(results, save, opened))
+  writer.start()
+  # no point starting the browsers if nothing they find can be saved
+  if (e := opened.get()) is not None:
+    writer.join()
+    raise e
+
+  pool, workers = [], []
+  try:
+    l.info(f'starting {drivers} drivers...')
+    # one at a time, so the ones started are quit if another fails to start
+    for _ in range(drivers):
+      pool.append(Driver())
+    workers = [threading.Thread(target=crawl_tiles, args=(d, tile_queue, results, capture))
+        for d in pool]
+    for w in workers:
+      w.start()
+    # split tiles are queued before their parent is done
+    tile_queue.join()
+  finally:
+    for w in workers:
+      tile_queue.put(None)
+    for w in workers:
+      w.join()
+    for d in pool:
+      d.quit()
+    results.put(None)
+    writer.join()
@@ -0,0 +1 @@
+../lambda/dbwriter.py
\ No newline at end of file
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+import logging as l
+
+from schema import get_db, Property, insert_sql
+from dbwriter import Writer
+
+
+REQUIRED_FIELDS = ['zpid', 'beds', 'baths', 'area']
+CHUNK_SIZE = 1 << 16
+
+
+def parse_result(r):
+  '''property from a map search result'''
+  home_info = r.get('hdpData', {}).get('homeInfo', {})
+  price_str = r['price'].replace('$', '').replace(',', '').lower()
+  price = int(price_str[:-1]) * 1000 if price_str.endswith('k') else int(price_str)
+
+  return Property(
+      price=price,
+      zillow_estimate=home_info.get('zestimate'),
+      rent_estimate=home_info.get('rentZestimate'),
+      tax_addressed_value=home_info.get('taxAddressedValue'),
+      price_reduction=home_info.get('priceReduction'),
+      zpid=int(r['zpid']),
+      beds=r['beds'],
+      bath=r['baths'],
+      area=r['area'],
+      home_type=home_info.get('homeType'),
+      status=r['statusType'],
+      image_url=r['imgSrc'],
+      detail_url=r['detailUrl'],
+      latitude=r['latLong']['latitude'],
+      longitude=r['latLong']['longitude'],
+      address=r['address'] if r['address'] != '--' else None,
+      city=home_info.get('city'),
+      state=home_info.get('state'),
+      zipcode=home_info.get('zipcode'),
+    )
+
+
+def is_complete(r) -> bool:
+  return all(f in r and r[f] is not None for f in REQUIRED_FIELDS)
+
+
+def save_results(conn, c, res):
+  '''save map search results'''
+  # one transaction for the whole page of results
+  with Writer(conn) as w:
+    for r in res:
+      if is_complete(r):
+        w.add(*insert_sql(parse_result(r), upsert=True))
+  l.info(f'saved {w.written} of {len(res)} results')
+
+
+def iter_map_results(f, chunk_size=CHUNK_SIZE):
+  '''yield the map results in a saved search response one at a time, reading
+  it in chunks instead of loading it whole. a bare list of results works too'''
+  decoder = json.JSONDecoder()
+  buf, i = f.read(chunk_size), 0
+
+  def more():
+    nonlocal buf, i
+    chunk = f.read(chunk_size)
+    if not chunk:
+      raise ValueError(f'{f.name} ended inside the results')
+    buf, i = buf[i:] + chunk, 0
+
+  def skip(chars):
+    # skip whitespace and `chars`, reading more as needed
+    nonlocal i
+    while True:
+      while i < len(buf) and (buf[i].isspace() or buf[i] in chars):
+        i += 1
+      if i < len(buf):
+        return
+      more()
+
+  # skip to the results array, unless the file is just that
+  if buf.lstrip()[:1] != '[':
+    key = '"mapResults"'
+    while (j := buf.find(key)) < 0:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        return
+      buf = buf[-len(key):] + chunk
+    i = j + len(key)
+    skip(':')
+  skip('')
+  if buf[i] != '[':
+    raise ValueError(f'{f.name} has no list of results')
+  i += 1
+
+  while True:
+    skip(',')
+    if buf[i] == ']':
+      return
+    try:
+      r, i = decoder.raw_decode(buf, i)
+    except json.JSONDecodeError:
+      # result cut off at the end of the chunk
+      more()
+      continue
+    yield r
+
+
+def parse_capture(path):
+  '''insert statement and values for the complete results in a capture'''
+  sql, rows = None, []
+  with open(path) as f:
+    for r in iter_map_results(f):
+      if is_complete(r):
+        sql, values = insert_sql(parse_result(r), upsert=True)
+        rows.append(values)
+  return sql, rows
+
+
+def ingest(args):
+  '''load captured search responses, parsing files in parallel. later files
+  win for homes in several'''
+  paths = []
+  for p in args.paths:
+    paths += sorted(os.path.join(p, n) for n in os.listdir(p)) if os.path.isdir(p) else [p]
+  conn, c = get_db()
+
+  start = time.perf_counter()
+  with ProcessPoolExecutor(max_workers=args.jobs) as ex, Writer(conn) as w:
+    for path, (sql, rows) in zip(paths, ex.map(parse_capture, paths)):
+      w.add_many(sql, rows)
+      l.info(f'{path}: {len(rows)} results')
+  t = time.perf_counter() - start
+  l.info(f'Ingested {w.written} results from {len(paths)} files in {t:.2f}s '
+      f'({w.written / t:.0f} results/s)')
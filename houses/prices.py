@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import datetime
+from dataclasses import dataclass
+import logging as l
+
+from schema import get_db
+
+
+REDUCTION_DAYS = 7
+
+HISTORY_SQL = '''
+SELECT date, price, status, zillow_estimate, rent_estimate
+FROM pricechange WHERE zpid = ? ORDER BY id
+'''
+
+# price drops recorded since a date, biggest relative drop first. the
+# previous change of a home is found through its zpid index
+REDUCTIONS_SQL = '''
+SELECT p.zpid, ch.date, prev.price, ch.price, p.address FROM pricechange ch
+JOIN pricechange prev ON prev.id = (
+  SELECT max(id) FROM pricechange WHERE zpid = ch.zpid AND id < ch.id)
+JOIN property p ON p.zpid = ch.zpid
+WHERE ch.date >= ? AND ch.price < prev.price
+ORDER BY ch.price / prev.price
+LIMIT ?
+'''
+
+
+@dataclass
+class PricePoint:
+  date: str
+  price: float
+  status: str
+  zillow_estimate: float
+  rent_estimate: float
+
+
+@dataclass
+class Reduction:
+  zpid: int
+  date: str
+  old_price: float
+  price: float
+  address: str
+
+  def percent(self) -> float:
+    return 100 * (self.old_price - self.price) / self.old_price
+
+
+def price_history(c, zpid) -> list[PricePoint]:
+  '''every change of price, status or estimates of home `zpid`, oldest first'''
+  return [PricePoint(*r) for r in c.execute(HISTORY_SQL, (zpid,))]
+
+
+def recent_reductions(c, days=REDUCTION_DAYS, limit=None) -> list[Reduction]:
+  since = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+  return [Reduction(*r) for r in c.execute(REDUCTIONS_SQL, (since, limit or -1))]
+
+
+def history(args):
+  '''price history of a home'''
+  conn, c = get_db()
+  for p in price_history(c, args.zpid):
+    l.info(f'{p.date} ${p.price:>11,.0f} {p.status} '
+        f'estimate {p.zillow_estimate} rent {p.rent_estimate}')
+
+
+def reductions(args):
+  '''homes whose price dropped in the last --days'''
+  conn, c = get_db()
+  for r in recent_reductions(c, args.days, args.k):
+    l.info(f'{r.zpid:>12} {r.date} ${r.old_price:>11,.0f} -> ${r.price:>11,.0f} '
+        f'({r.percent():.1f}%) {r.address}')
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 import os
 from enum import StrEnum
-import sqlite3
+from operator import attrgetter
+from functools import cache
+from collections.abc import Callable
 from dataclasses import dataclass, field, fields
 import logging as l
+from dbwriter import connect
 
 
 DBNAME = 'houses.db'
@@ -25,7 +28,7 @@ class Property:
   rent_estimate: float = field(metadata={'NOT NULL': False})
   tax_addressed_value: float = field(metadata={'NOT NULL': False})
   price_reduction: str = field(metadata={'NOT NULL': False})
-  zpid: int
+  zpid: int = field(metadata={'UNIQUE INDEX': True})
   date: str = field(metadata={'DEFAULT': 'CURRENT_DATE'}, init=False, default=None)
 
   beds: int
@@ -46,7 +49,21 @@ class Property:
   zipcode: str
 
 
+@dataclass(kw_only=True)
+class PriceChange:
+  '''price, status and estimates of a home, recorded by triggers on
+  `property` only when one of them changes'''
+  id: int = field(metadata={'PRIMARY KEY': True}, init=False, default=None)
+  zpid: int = field(metadata={'INDEX': True})
+  date: str = field(metadata={'DEFAULT': 'CURRENT_DATE', 'INDEX': True}, init=False, default=None)
+  price: float
+  status: Status
+  zillow_estimate: float = field(metadata={'NOT NULL': False})
+  rent_estimate: float = field(metadata={'NOT NULL': False})
+
+
 CREATE_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS {} (\n  {}\n)'''
+CREATE_INDEX_SQL = '''CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'''
 
 TYPE_SQL_MAP = {
     'int': 'INTEGER',
@@ -54,8 +71,26 @@ TYPE_SQL_MAP = {
     'str': 'TEXT',
     }
 
+# field metadata that is not a column constraint
+INDEX_KEYS = ('INDEX', 'UNIQUE INDEX')
+
+
+def table_name(cls) -> str:
+  return cls.__name__.lower()
+
+
+def index_name(cls, f) -> str:
+  return f'{table_name(cls)}_{f.name}'
+
+
+def unique_fields(cls) -> list[str]:
+  return [f.name for f in fields(cls) if f.metadata.get('UNIQUE INDEX')]
+
+
 def create_table_sql(cls) -> str:
+  '''table for dataclass `cls`, followed by the indexes its fields ask for'''
   fields_data: list[str] = []
+  indexes: list[str] = []
 
   for f in fields(cls):
     type_name = f.type.__name__
@@ -68,41 +103,154 @@ def create_table_sql(cls) -> str:
     extra_args = [
         f'{k}{"" if v == True else " "+str(v)}'
         for k, v in metadata.items()
-        if v]
+        if v and k not in INDEX_KEYS]
 
     fields_data.append(f'{f.name} {sql_type}{" ".join([""] + extra_args)}')
 
-  return CREATE_TABLE_SQL.format(
-      cls.__name__.lower(),
-      ',\n  '.join(fields_data))
+    for k in INDEX_KEYS:
+      if metadata.get(k):
+        indexes.append(CREATE_INDEX_SQL.format(
+          'UNIQUE ' if k == 'UNIQUE INDEX' else '',
+          index_name(cls, f), table_name(cls), f.name))
+
+  return ';\n'.join([CREATE_TABLE_SQL.format(
+      table_name(cls),
+      ',\n  '.join(fields_data))] + indexes)
 
 
 INSERT_SQL = '''INSERT INTO {} ({}) VALUES ({})'''
+UPSERT_SQL = '''{} ON CONFLICT ({}) DO UPDATE SET {}'''
 
-def insert_sql(ins) -> tuple[str, list]:
-  # look up values in the dict representation
-  column_names = [f.name for f in fields(ins) if f.init]
-  values = [ins.__dict__[name] for name in column_names]
+@cache
+def compile_insert_sql(cls, upsert=False) -> tuple[str, Callable]:
+  '''insert statement for dataclass `cls` and a getter for its values, made
+  once per class. an upsert updates the row with the same unique fields'''
+  column_names = [f.name for f in fields(cls) if f.init]
   # automatically generate number of '?'
   sql = INSERT_SQL.format(
-      ins.__class__.__name__.lower(),
+      table_name(cls),
       ', '.join(column_names),
-      ', '.join(['?']*len(values)))
+      ', '.join(['?']*len(column_names)))
+
+  if upsert:
+    keys = unique_fields(cls)
+    updates = [f'{name} = excluded.{name}'
+        for name in column_names if name not in keys]
+    # columns filled in by the db are refreshed too, e.g. the date seen
+    updates += [f'{f.name} = {f.metadata["DEFAULT"]}'
+        for f in fields(cls) if not f.init and 'DEFAULT' in f.metadata]
+    sql = UPSERT_SQL.format(sql, ', '.join(keys), ', '.join(updates))
+
+  getter = attrgetter(*column_names)
+  # attrgetter returns a bare value for a single name
+  return sql, getter if len(column_names) > 1 else lambda ins: (getter(ins),)
+
+
+def insert_sql(ins, upsert=False) -> tuple[str, tuple]:
+  sql, getter = compile_insert_sql(ins.__class__, upsert)
+  return sql, getter(ins)
+
+
+def dedupe(conn, c, cls):
+  '''keep only the latest row for each value of a unique field, so its
+  index can be created on a table from before there was one'''
+  names = {r[0] for r in c.execute('''SELECT name FROM sqlite_master''')}
+  if table_name(cls) not in names:
+    return
+  for f in fields(cls):
+    if f.metadata.get('UNIQUE INDEX') and index_name(cls, f) not in names:
+      c.execute(f'''
+          DELETE FROM {table_name(cls)} WHERE rowid NOT IN (
+            SELECT max(rowid) FROM {table_name(cls)} GROUP BY {f.name})''')
+      l.info(f'Removed {c.rowcount} duplicate {f.name} rows')
+  conn.commit()
+
+
+# r*tree of where each property is, kept in sync with the table by triggers
+SPATIAL_INDEX_SQL = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS property_location
+  USING rtree(id, min_lng, max_lng, min_lat, max_lat);
+CREATE TRIGGER IF NOT EXISTS property_location_insert
+AFTER INSERT ON property BEGIN
+  INSERT INTO property_location
+  VALUES (NEW.id, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude);
+END;
+CREATE TRIGGER IF NOT EXISTS property_location_update
+AFTER UPDATE OF latitude, longitude ON property BEGIN
+  UPDATE property_location
+  SET min_lng = NEW.longitude, max_lng = NEW.longitude,
+    min_lat = NEW.latitude, max_lat = NEW.latitude
+  WHERE id = NEW.id;
+END;
+CREATE TRIGGER IF NOT EXISTS property_location_delete
+AFTER DELETE ON property BEGIN
+  DELETE FROM property_location WHERE id = OLD.id;
+END
+'''
+
 
-  return sql, values
+# columns of a property tracked in `pricechange`
+PRICE_COLUMNS = ('price', 'status', 'zillow_estimate', 'rent_estimate')
+
+PRICE_CHANGE_SQL = f'''
+CREATE TRIGGER IF NOT EXISTS pricechange_insert
+AFTER INSERT ON property BEGIN
+  INSERT INTO pricechange (zpid, {', '.join(PRICE_COLUMNS)})
+  VALUES (NEW.zpid, {', '.join(f'NEW.{k}' for k in PRICE_COLUMNS)});
+END;
+CREATE TRIGGER IF NOT EXISTS pricechange_update
+AFTER UPDATE OF {', '.join(PRICE_COLUMNS)} ON property
+WHEN {' OR '.join(f'OLD.{k} IS NOT NEW.{k}' for k in PRICE_COLUMNS)}
+BEGIN
+  INSERT INTO pricechange (zpid, {', '.join(PRICE_COLUMNS)})
+  VALUES (NEW.zpid, {', '.join(f'NEW.{k}' for k in PRICE_COLUMNS)});
+END
+'''
+
+# a change for the first row of each home and whenever the tracked columns
+# differ from its previous row, out of one row per home per crawl
+SEED_PRICE_CHANGES_SQL = f'''
+INSERT INTO pricechange (zpid, date, {', '.join(PRICE_COLUMNS)})
+SELECT zpid, date, {', '.join(PRICE_COLUMNS)} FROM (
+  SELECT *, row_number() OVER w AS n,
+    {', '.join(f'lag({k}) OVER w AS prev_{k}' for k in PRICE_COLUMNS)}
+  FROM property
+  WINDOW w AS (PARTITION BY zpid ORDER BY id)
+)
+WHERE n = 1 OR {' OR '.join(f'{k} IS NOT prev_{k}' for k in PRICE_COLUMNS)}
+ORDER BY id
+'''
 
 
 def initialize_db(conn, c):
-  c.execute(create_table_sql(Property))
+  names = {r[0] for r in c.execute('''SELECT name FROM sqlite_master''')}
+  c.executescript(create_table_sql(PriceChange))
+  if 'pricechange' not in names and 'property' in names:
+    # before duplicates are dropped, they are the price history
+    c.execute(SEED_PRICE_CHANGES_SQL)
+    l.info(f'Recorded {c.rowcount} price changes from saved properties')
+    conn.commit()
+
+  dedupe(conn, c, Property)
+  c.executescript(create_table_sql(Property))
+  c.executescript(PRICE_CHANGE_SQL)
+
+  c.executescript(SPATIAL_INDEX_SQL)
+  if 'property_location' not in names:
+    # index properties saved before there was one
+    c.execute('''
+        INSERT INTO property_location
+        SELECT id, longitude, longitude, latitude, latitude FROM property''')
   conn.commit()
 
 
 def get_db(migrate=False):
   '''get cursor to db, setup schema if not present'''
   exists = os.path.exists(DBNAME)
-  conn = sqlite3.connect(DBNAME)
+  conn = connect(DBNAME)
   c = conn.cursor()
   if not exists or migrate:
     l.info('Database not found/outdated. Setting up schema...')
-    initialize_db(conn, c)
+  # cheap when it's all there, and adds indexes to older dbs
+  initialize_db(conn, c)
   return conn, c
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import math
+from statistics import median
+from dataclasses import dataclass
+import logging as l
+
+from schema import get_db
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+# radius the nearest home search starts at, and gives up after
+NEAREST_START_KM = 0.5
+NEAREST_MAX_KM = 200
+
+# homes whose indexed box overlaps the query box. the r*tree keeps 32 bit
+# floats, so the exact coordinates are checked as well
+BBOX_SQL = '''
+SELECT p.zpid, p.price, p.area, p.zillow_estimate, p.latitude, p.longitude, p.address
+FROM property_location r
+JOIN property p ON p.id = r.id
+WHERE r.min_lng <= :east AND r.max_lng >= :west
+  AND r.min_lat <= :north AND r.max_lat >= :south
+  AND p.longitude BETWEEN :west AND :east
+  AND p.latitude BETWEEN :south AND :north
+'''
+
+
+@dataclass
+class Home:
+  zpid: int
+  price: float
+  area: int
+  zillow_estimate: float
+  latitude: float
+  longitude: float
+  address: str
+  distance_km: float = None
+
+
+def distance_km(lat1, lng1, lat2, lng2) -> float:
+  '''great circle distance'''
+  lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+  a = (math.sin((lat2 - lat1) / 2) ** 2
+      + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+  return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def within_bbox(c, west, south, east, north) -> list[Home]:
+  return [Home(*r) for r in c.execute(BBOX_SQL,
+    {'west': west, 'south': south, 'east': east, 'north': north})]
+
+
+def within_radius(c, lat, lng, km) -> list[Home]:
+  '''homes within `km` of a point, nearest first'''
+  dlat = km / KM_PER_DEGREE
+  dlng = km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+  homes = []
+  for h in within_bbox(c, lng - dlng, lat - dlat, lng + dlng, lat + dlat):
+    h.distance_km = distance_km(lat, lng, h.latitude, h.longitude)
+    if h.distance_km <= km:
+      homes.append(h)
+  return sorted(homes, key=lambda h: h.distance_km)
+
+
+def nearest(c, lat, lng, k, exclude=None) -> list[Home]:
+  '''`k` homes nearest to a point, searching a radius that doubles until it
+  holds enough of them. anything nearer than the k-th is inside it too'''
+  km = NEAREST_START_KM
+  while True:
+    homes = [h for h in within_radius(c, lat, lng, km) if h.zpid != exclude]
+    if len(homes) >= k or km >= NEAREST_MAX_KM:
+      return homes[:k]
+    km *= 2
+
+
+def comparables(c, zpid, k) -> list[Home]:
+  '''`k` homes nearest to home `zpid`'''
+  r = c.execute('''SELECT latitude, longitude FROM property WHERE zpid = ?''',
+      (zpid,)).fetchone()
+  if not r:
+    raise KeyError(f'no home with zpid {zpid}')
+  return nearest(c, *r, k, exclude=zpid)
+
+
+def neighborhood_stats(homes) -> dict[str, float]:
+  '''price per sqft and zillow estimate vs price of `homes`'''
+  per_sqft = [h.price / h.area for h in homes if h.area]
+  vs_price = [h.zillow_estimate / h.price for h in homes
+      if h.zillow_estimate and h.price]
+  return {
+      'homes': len(homes),
+      'median_price': median(h.price for h in homes) if homes else None,
+      'median_price_per_sqft': median(per_sqft) if per_sqft else None,
+      'mean_price_per_sqft': sum(per_sqft) / len(per_sqft) if per_sqft else None,
+      'median_estimate_vs_price': median(vs_price) if vs_price else None,
+      }
+
+
+def near(args):
+  '''homes near a home or a point, with stats for the neighborhood'''
+  conn, c = get_db()
+  if args.zpid:
+    homes = comparables(c, args.zpid, args.k)
+  else:
+    lat, lng = (float(x) for x in args.point.split(','))
+    homes = (within_radius(c, lat, lng, args.radius) if args.radius
+        else nearest(c, lat, lng, args.k))
+
+  for h in homes:
+    l.info(f'{h.zpid:>12} {h.distance_km:6.2f}km ${h.price:>11,.0f} '
+        f'{h.area:>6}sqft {h.address}')
+  for k, v in neighborhood_stats(homes).items():
+    l.info(f'{k}: {v if v is None else round(v, 3)}')
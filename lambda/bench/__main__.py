@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+'''benchmarks for the hot paths, run from lambda/ with `python -m bench`'''
+import os
+import sys
+import json
+import argparse
+import tempfile
+import time
+import timeit
+import functools
+import multiprocessing
+import logging as l
+from bench import fixtures, legacy
+from bench.stages import Stages, save_run, load_runs, find_baseline, compare_runs, RESULTS_FN, THRESHOLD
+
+
+def timed(func, number):
+  '''best time per call of `func` over a few repeats'''
+  return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+
+def report(name, t, baseline=None):
+  speedup = f' ({baseline / t:.1f}x)' if baseline else ''
+  l.info(f'{name:<24} {t * 1000:9.3f} ms{speedup}')
+
+
+def report_rate(name, rows, t, baseline=None):
+  speedup = f' ({baseline / t:.1f}x)' if baseline else ''
+  l.info(f'{name:<24} {rows / t:9.0f} rows/s{speedup}')
+
+
+def bench_extract(args):
+  '''extractor registry vs the old full page parse'''
+  from extract import get_extractor, PARSER
+
+  if args.page:
+    with open(args.page) as f:
+      body = f.read()
+  else:
+    body = fixtures.apartments_page()
+  e = get_extractor('https://www.apartments.com/')
+  assert e.extract(body) == legacy.extract_apartments(body)
+
+  l.info(f'page: {len(body)} bytes, parser: {PARSER}')
+  base = timed(lambda: legacy.extract_apartments(body), args.number)
+  report('legacy extract', base)
+  report('extractor', timed(lambda: e.extract(body), args.number), base)
+
+
+def bench_history(args):
+  '''day x unit price grid over hourly history'''
+  # history needs secrets/ like the app itself
+  from history import pivot_price_data
+
+  apmts, hdata = fixtures.price_data(units=args.units, days=args.days)
+  l.info(f'{len(hdata)} units x {args.days} days of hourly prices')
+  assert pivot_price_data(apmts, hdata) == legacy.pivot_price_data(apmts, hdata)[0]
+
+  base = timed(lambda: legacy.pivot_price_data(apmts, hdata), 1)
+  report('legacy pivot', base)
+  report('pivot', timed(lambda: pivot_price_data(apmts, hdata), 1), base)
+
+
+def bench_writes(args):
+  '''dump inserts committed one by one vs batched by the writer'''
+  import sqlite3
+  from schema import Dump, migrate
+  from dbwriter import connect, Writer
+
+  rows = fixtures.dump_rows(args.rows)
+  sql = '''INSERT INTO dumps (url, timestamp, status, body, extracted)
+      VALUES (?, ?, ?, ?, ?)'''
+
+  def per_row(conn, c):
+    for r in rows:
+      Dump(None, *r).insert(conn, c)
+
+  def batched(conn, c):
+    with Writer(conn) as w:
+      w.add_many(sql, rows)
+
+  def run(conn, write):
+    c = conn.cursor()
+    migrate(conn, c)
+    t = time.perf_counter()
+    write(conn, c)
+    t = time.perf_counter() - t
+    assert c.execute('''SELECT count(*) FROM dumps''').fetchone()[0] == len(rows)
+    conn.close()
+    return t
+
+  l.info(f'{len(rows)} dumps')
+  with tempfile.TemporaryDirectory() as tmp:
+    base = run(sqlite3.connect(os.path.join(tmp, 'a.db')), per_row)
+    report_rate('per row commit', len(rows), base)
+    report_rate('per row commit, pragmas', len(rows),
+        run(connect(os.path.join(tmp, 'b.db')), per_row), base)
+    report_rate('writer', len(rows),
+        run(connect(os.path.join(tmp, 'c.db')), batched), base)
+
+
+def sizes(args):
+  return {k: getattr(args, k) for k in ('urls', 'units', 'months', 'homes', 'days')}
+
+
+def bench_generate(args):
+  '''write a synthetic dumps.db and sheets data to --out'''
+  os.makedirs(args.out, exist_ok=True)
+  apmts = fixtures.apartments(args.urls)
+  with open(os.path.join(args.out, 'sheets_data.json'), 'w') as f:
+    json.dump(apmts, f)
+  n = fixtures.generate_dumps_db(os.path.join(args.out, 'dumps.db'), apmts,
+      args.units, args.months)
+  l.info(f'Generated {n} dumps in {args.out}')
+
+
+def bench_suite(args):
+  '''time and peak memory of each stage of a run, on generated data against
+  the local stand-in. saved to --results'''
+  if 'GCS_BUCKET_NAME' in os.environ:
+    sys.exit('GCS_BUCKET_NAME is set, the app would use the dbs in /tmp')
+  # the app reads secrets/ on import, and data/ from wherever it runs
+  import fetch
+  import extract
+  import update
+  import history
+  from schema import Dump, get_db, reset_price_history, DBNAME
+  from sheets import SHEETS_DATA_FN
+  from notify import diff_units
+  from compact import compact_dumps, RETENTION
+  from bench.server import serve
+  from bench.houses import houses_stages
+
+  stages = Stages()
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as tmp, serve(args.latency, args.units) as url:
+    os.chdir(tmp)
+    os.makedirs(os.path.dirname(DBNAME))
+    extract.EXTRACTORS['127.0.0.1'] = extract.ApartmentsExtractor()
+    # nothing to email, and no per host throttling of the stand-in
+    update.EMAIL_RECIPIENTS = []
+    fetch.Fetcher = functools.partial(fetch.Fetcher, rate=args.rate, burst=args.rate)
+
+    apmts = fixtures.apartments(args.urls, url)
+    with open(SHEETS_DATA_FN, 'w') as f:
+      json.dump(apmts, f)
+    with stages.stage('generate dumps.db'):
+      n = fixtures.generate_dumps_db(DBNAME, apmts, args.units, args.months,
+          end=time.time() - 2 * update.PULL_INTERVAL)
+    l.info(f'{n} dumps, {os.path.getsize(DBNAME) / 2**20:.1f} MiB')
+
+    run_args = argparse.Namespace(local=True, dry_run=False, force=False,
+        retention=RETENTION)
+    with stages.stage('update_dumps'):
+      update.update_dumps(run_args)
+
+    pages = [Dump(0, a['url'], 0, 200, fixtures.apartments_page(1, args.units), None)
+        for a in apmts]
+    with stages.stage('extract_dump'):
+      for d in pages:
+        update.extract_dump(d)
+
+    conn, c = get_db()
+    reset_price_history(c)
+    conn.commit()
+    with stages.stage('get_price_history cold'):
+      history.get_price_history(conn, c)
+    with stages.stage('get_price_history warm'):
+      history.get_price_history(conn, c)
+
+    snapshots = c.execute('''
+        SELECT url, timestamp, extracted FROM dumps
+        WHERE status = 200 ORDER BY url, timestamp''').fetchall()
+    conn.close()
+    with stages.stage('diff_units'):
+      for (url, _, old), (next_url, t, new) in zip(snapshots, snapshots[1:]):
+        if url == next_url:
+          diff_units(url, json.loads(old), json.loads(new), t)
+    del snapshots
+
+    with stages.stage('compact'):
+      compact_dumps(run_args)
+
+    # a fresh process, which also keeps its memory out of these stages
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+      houses = pool.apply(houses_stages, (tmp, args.homes, args.days))
+    for name, r in houses.items():
+      l.info(f'{name:<28} {r["seconds"]:9.3f} s {r["peak_mib"]:9.1f} MiB')
+    stages.results.update(houses)
+    os.chdir(cwd)
+
+  save_run(sizes(args), stages.results, args.results)
+
+
+def bench_compare(args):
+  '''compare the last saved run against --baseline, or the last run of
+  another commit, and fail on regressions'''
+  runs = load_runs(args.results)
+  if not runs:
+    sys.exit(f'no runs saved in {args.results}')
+  run = runs[-1]
+  base = find_baseline(runs, run, args.baseline)
+  if not base:
+    sys.exit(f'no run of {args.baseline or "another commit"} at sizes {run["sizes"]}')
+  l.info(f'{base["commit"]} -> {run["commit"]} at {run["sizes"]}')
+  regressions = compare_runs(base, run, args.threshold)
+  if regressions:
+    sys.exit(f'{len(regressions)} stages regressed: {", ".join(regressions)}')
+
+
+def main():
+  action_funcs = {
+      'extract': bench_extract,
+      'history': bench_history,
+      'writes': bench_writes,
+      'generate': bench_generate,
+      'suite': bench_suite,
+      'compare': bench_compare,
+      }
+
+  parser = argparse.ArgumentParser(description='sentineld benchmarks')
+  parser.add_argument('action', choices=action_funcs.keys())
+  parser.add_argument('--page', help='saved page to benchmark extraction on')
+  parser.add_argument('--units', type=int, default=10,
+      help='units per apartment in generated history')
+  parser.add_argument('--days', type=int, default=90,
+      help='days of generated history, or of crawls of houses')
+  parser.add_argument('--rows', type=int, default=2000,
+      help='rows to write')
+  parser.add_argument('-n', '--number', type=int, default=20,
+      help='calls per timing')
+  parser.add_argument('--urls', type=int, default=20,
+      help='apartments in generated data')
+  parser.add_argument('--months', type=int, default=3,
+      help='months of hourly dumps in generated data')
+  parser.add_argument('--homes', type=int, default=10000,
+      help='homes per generated crawl of houses')
+  parser.add_argument('--latency', type=float, default=0.05,
+      help='seconds the stand-in takes to respond')
+  parser.add_argument('--rate', type=float, default=100,
+      help='requests per second to the stand-in')
+  parser.add_argument('--out', default='data/bench',
+      help='directory to generate data in')
+  parser.add_argument('--results', default=RESULTS_FN,
+      help='file runs of the suite are saved to')
+  parser.add_argument('--baseline',
+      help='commit to compare against')
+  parser.add_argument('--threshold', type=float, default=THRESHOLD,
+      help='slowdown or memory growth that counts as a regression')
+  args = parser.parse_args()
+  action_funcs[args.action](args)
+
+
+if __name__ == '__main__':
+  l.basicConfig(level=l.INFO, format='%(message)s')
+  main()
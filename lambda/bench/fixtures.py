@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+'''synthetic data shaped like what sentineld scrapes'''
+
+
+def apartments_page(models=4, units=6, padding=4000, base_price=1500):
+  '''apartments.com shaped page with `models` x `units` units per tab,
+  surrounded by `padding` words of unrelated markup'''
+  junk = '<div class="junk">' + '<p>lorem ipsum</p>' * (padding // 2) + '</div>'
+  out = ['<html><head><title>Apartments</title></head><body>', junk,
+      '<div id="pricingView">']
+  for tab in ('bed1', 'bed2'):
+    out.append(f'<div data-tab-content-id="{tab}">')
+    for m in range(models):
+      out.append(
+          '<div class="pricingGridItem"><div class="priceBedRangeInfo">'
+          f'<span class="modelName"> Model {tab}-{m} </span></div><ul>')
+      for u in range(units):
+        out.append(
+            '<li class="unitContainer">'
+            f'<div class="unitColumn"><span class="screenReaderOnly">Unit</span> {m}{u:02d} </div>'
+            f'<div class="pricingColumn"><span class="screenReaderOnly">price</span> ${base_price + m * 100 + u:,} </div>'
+            f'<div class="sqftColumn"><span class="screenReaderOnly">square feet</span> {700 + u * 10:,} </div>'
+            '<div class="availableColumn"><span class="screenReaderOnly">availibility</span> Now </div>'
+            '</li>')
+      out.append('</ul></div>')
+    out.append('</div>')
+  out += ['</div>', junk, '</body></html>']
+  return '\n'.join(out)
+
+
+def price_data(apartments=5, units=10, days=365, per_day=24, start=1640995200):
+  '''(apmts, hdata) as returned by history.get_price_data, for `units` units
+  in each of `apartments` scraped `per_day` times a day for `days` days'''
+  from datetime import datetime as dt
+
+  apmts = [{'name': f'Apartment {i}', 'url': f'https://www.apartments.com/a{i}/'}
+      for i in range(apartments)]
+  times = [dt.fromtimestamp(start + n * 86400 // per_day)
+      for n in range(days * per_day)]
+  hdata = []
+  for i in range(apartments):
+    for u in range(units):
+      h = [(1500 + (n // (per_day * 7) + u) % 50, t) for n, t in enumerate(times)]
+      hdata.append(((i, 'Model A', f'{u:03d}'), h))
+  return apmts, hdata
+
+
+def dump_rows(n=2000, start=1640995200):
+  '''(url, timestamp, status, body, extracted) of `n` small hourly dumps'''
+  return [(f'https://www.apartments.com/a{i % 20}/', start + i * 3600, 200, '',
+      f'[{{"model": "A", "unit": "{i}", "price": {1500 + i % 100}}}]')
+      for i in range(n)]
+
+
+def page_units(units=10, base_price=1500):
+  '''what gets extracted from `apartments_page(1, units, ...)`'''
+  return [{'model': 'Model bed1-0', 'unit': f'0{u:02d}', 'price': base_price + u,
+      'sqft': 700 + u * 10, 'available': 'Now'} for u in range(units)]
+
+
+def apartments(urls=20, base_url='https://www.apartments.com'):
+  '''sheets data listing `urls` apartments'''
+  return [{'name': f'Apartment {i}', 'url': f'{base_url}/a{i}/'}
+      for i in range(urls)]
+
+
+def generate_dumps_db(path, apmts, units=10, months=3, end=None, change=0.02, seed=0):
+  '''dumps.db at `path` with a dump of every apartment in `apmts` each hour
+  for `months` up to `end`, the way they were stored before unchanged pulls
+  were merged. each hour a price moves with probability `change`.
+  returns the number of dumps'''
+  import json
+  import time
+  import random
+  from schema import migrate
+  from extract import get_fingerprint
+  from dbwriter import connect, Writer
+
+  rng = random.Random(seed)
+  end = end or time.time()
+  hours = months * 30 * 24
+  conn = connect(path)
+  c = conn.cursor()
+  migrate(conn, c)
+
+  id = 0
+  with Writer(conn) as w:
+    for a in apmts:
+      price = 1500
+      for h in range(hours):
+        if rng.random() < change:
+          price += rng.choice((-25, 25))
+        data = page_units(units, price)
+        t = end - (hours - h) * 3600
+        id += 1
+        w.add('''
+            INSERT INTO dumps (id, url, timestamp, status, body, extracted,
+              fingerprint, extractor_version)
+            VALUES (?, ?, ?, 200, '', ?, ?, 1)''',
+            (id, a['url'], t, json.dumps(data), get_fingerprint(data)))
+        for u in data:
+          w.add('''
+              INSERT INTO observations
+                (dump_id, url, model, unit, timestamp, price, sqft, available)
+              VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+              (id, a['url'], u['model'], u['unit'], t, u['price'], u['sqft'], u['available']))
+  conn.close()
+  return id
+
+
+def map_results(homes=10000, seed=0, change=0.0):
+  '''zillow map search results for `homes` homes around Orlando, a fraction
+  `change` of them priced differently than with `change` 0'''
+  import random
+  rng = random.Random(seed)
+  moved = random.Random(seed + 1)
+  res = []
+  for i in range(homes):
+    price = 200000 + rng.randrange(0, 800000, 1000)
+    if moved.random() < change:
+      price -= 5000
+    res.append({
+        'zpid': str(10000000 + i),
+        'price': f'${price:,}',
+        'beds': rng.randint(1, 6),
+        'baths': rng.randint(1, 4),
+        'area': rng.randint(600, 5000),
+        'statusType': 'FOR_SALE',
+        'imgSrc': f'https://photos.zillowstatic.com/fp/{i}-p_e.jpg',
+        'detailUrl': f'https://www.zillow.com/homedetails/{10000000 + i}_zpid/',
+        'latLong': {
+          'latitude': 28.35 + rng.random() * 0.5,
+          'longitude': -81.58 + rng.random() * 0.5,
+          },
+        'address': f'{i} Main St, Orlando, FL 32801',
+        'hdpData': {'homeInfo': {
+          'zestimate': price + rng.randint(-20000, 20000),
+          'rentZestimate': rng.randint(1200, 4000),
+          'homeType': 'SINGLE_FAMILY',
+          'city': 'Orlando',
+          'state': 'FL',
+          'zipcode': '32801',
+          }},
+        })
+  return res
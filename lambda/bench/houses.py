@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+'''houses/ stages, run in a process of their own since houses/ has modules
+named like the ones here'''
+import os
+import sys
+from bench import fixtures
+from bench.stages import Stages
+
+
+HOUSES_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..', 'houses'))
+# homes per page of search results
+PAGE_SIZE = 500
+
+
+def save_crawl(conn, c, res):
+  from ingest import save_results
+  for i in range(0, len(res), PAGE_SIZE):
+    save_results(conn, c, res[i:i + PAGE_SIZE])
+
+
+def houses_stages(tmp, homes, days):
+  '''houses.db in `tmp` with `homes` homes crawled on `days` days, then the
+  time to save one more crawl. returns the stage results'''
+  sys.path.insert(0, HOUSES_DIR)
+  os.chdir(tmp)
+  from schema import get_db
+
+  stages = Stages()
+  conn, c = get_db()
+  with stages.stage('houses generate'):
+    for d in range(days):
+      save_crawl(conn, c, fixtures.map_results(homes, change=d / days))
+  with stages.stage('houses save_results'):
+    save_crawl(conn, c, fixtures.map_results(homes, change=1))
+  conn.close()
+  return stages.results
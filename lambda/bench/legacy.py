@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+'''previous implementations, kept to benchmark against'''
+from bs4 import BeautifulSoup
+
+
+def extract_apartments(body):
+  '''extract_dump before the extractor registry'''
+  bs = BeautifulSoup(body, features='html.parser')
+  res = []
+  models = bs.select('#pricingView > div[data-tab-content-id="bed1"] .pricingGridItem')
+  for m in models:
+    model_name = m.select_one('.priceBedRangeInfo .modelName').text.strip()
+    for u in m.select('.unitContainer'):
+      # remove these tags
+      for s in u.select('.screenReaderOnly'):
+        s.extract()
+
+      res.append({
+        'model': model_name,
+        'unit': u.select_one('.unitColumn').text.strip(),
+        'price': int(u.select_one('.pricingColumn').text.strip()
+          .replace('$', '').replace(',', '')
+          ),
+        'sqft': int(u.select_one('.sqftColumn').text.strip()
+          .replace(',', '')
+          ),
+        'available': u.select_one('.availableColumn').text.strip(),
+        })
+  return res
+
+
+def pivot_price_data(apmts, hdata):
+  '''get_price_history's day x unit grid before it was built in one pass'''
+  from datetime import timedelta
+
+  dates = [t.date() for k, h in hdata for p, t in h]
+  min_date, max_date = min(dates), max(dates)
+  vals = [[None for n in range((max_date - min_date).days + 2)]
+      for _ in range(len(hdata) + 1)]
+
+  latest = []
+  for j, (k, h) in enumerate(hdata):
+    index, model, unit = k
+    vals[j+1][0] = f'{apmts[index]["name"]} - {model}/{unit}'
+
+  for n in range((max_date - min_date).days + 1):
+    d = min_date + timedelta(days=n)
+    vals[0][n+1] = d.strftime('%b %-d %Y')
+
+    for j, (k, h) in enumerate(hdata):
+      p, t = next(((p, t) for p, t in h[::-1] if t.date() == d), (None, None))
+      vals[j+1][n+1] = p
+
+      if d == max_date and p is not None:
+        latest.append((k, p, t))
+
+  return vals, latest
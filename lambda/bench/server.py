@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+'''local stand-in for apartments.com, serving fixture pages'''
+import re
+import time
+import random
+import threading
+from functools import cache
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from bench import fixtures
+
+
+@cache
+def page(units, base_price):
+  return fixtures.apartments_page(1, units, base_price=base_price).encode()
+
+
+class PageHandler(BaseHTTPRequestHandler):
+  '''serves `/a<n>/` as an apartment page whose prices move with probability
+  `server.change` on each request, after `server.latency` seconds'''
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    s = self.server
+    m = re.fullmatch(r'/a(\d+)/', self.path)
+    if not m:
+      self.send_error(404)
+      return
+    with s.lock:
+      price = s.prices.get(m[1], 1500)
+      if s.rng.random() < s.change:
+        price += s.rng.choice((-25, 25))
+      s.prices[m[1]] = price
+    time.sleep(s.latency)
+
+    body = page(s.units, price)
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/html; charset=utf-8')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+@contextmanager
+def serve(latency=0.05, units=10, change=0.1, seed=0):
+  '''run the stand-in on a free port, yields its base url'''
+  httpd = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+  httpd.daemon_threads = True
+  httpd.latency, httpd.units, httpd.change = latency, units, change
+  httpd.prices, httpd.rng, httpd.lock = {}, random.Random(seed), threading.Lock()
+  thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+  thread.start()
+  try:
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+  finally:
+    httpd.shutdown()
+    httpd.server_close()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+'''time and peak memory of benchmark stages, kept in a results file to
+compare commits against each other'''
+import os
+import re
+import sys
+import json
+import time
+import resource
+import subprocess
+import logging as l
+from contextlib import contextmanager
+
+
+RESULTS_FN = 'data/bench-results.jsonl'
+# a stage this many times slower or bigger than on the baseline regressed
+THRESHOLD = 1.25
+# differences smaller than these are noise
+MIN_SECONDS = 0.05
+MIN_MIB = 4
+
+
+def read_status_kib(key):
+  with open('/proc/self/status') as f:
+    return int(re.search(rf'{key}:\s+(\d+)', f.read())[1])
+
+
+def max_rss_kib():
+  r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return r // 1024 if sys.platform == 'darwin' else r
+
+
+def reset_peak():
+  '''start tracking the peak resident memory over again, only linux can'''
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    return read_status_kib('VmRSS')
+  except OSError:
+    return max_rss_kib()
+
+
+def peak_kib():
+  try:
+    return read_status_kib('VmHWM')
+  except OSError:
+    return max_rss_kib()
+
+
+class Stages:
+  '''records how long each stage takes, and how far above what the process
+  used when it started its memory peaks'''
+  def __init__(self):
+    self.results = {}
+
+  @contextmanager
+  def stage(self, name):
+    start_kib = reset_peak()
+    t = time.perf_counter()
+    yield
+    t = time.perf_counter() - t
+    mib = (peak_kib() - start_kib) / 1024
+    self.results[name] = {'seconds': round(t, 4), 'peak_mib': round(mib, 1)}
+    l.info(f'{name:<28} {t:9.3f} s {mib:9.1f} MiB')
+
+
+def git_commit():
+  '''commit the tree is at, with a + when it has uncommitted changes'''
+  try:
+    commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+        text=True, stderr=subprocess.DEVNULL).strip()
+    dirty = subprocess.check_output(['git', 'status', '--porcelain', '--', '.'],
+        text=True, stderr=subprocess.DEVNULL).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+  return commit + ('+' if dirty else '')
+
+
+def save_run(sizes, results, path=RESULTS_FN):
+  run = {'commit': git_commit(), 'time': int(time.time()),
+      'sizes': sizes, 'stages': results}
+  os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+  with open(path, 'a') as f:
+    f.write(json.dumps(run) + '\n')
+  l.info(f'Saved results of {run["commit"]} to {path}')
+  return run
+
+
+def load_runs(path=RESULTS_FN):
+  try:
+    with open(path) as f:
+      return [json.loads(line) for line in f if line.strip()]
+  except FileNotFoundError:
+    return []
+
+
+def find_baseline(runs, run, commit=None):
+  '''latest run of `commit`, or else of the last other commit, at the same
+  sizes as `run`'''
+  for r in reversed(runs):
+    if r['sizes'] != run['sizes'] or r is run:
+      continue
+    if (r['commit'] or '').startswith(commit) if commit else r['commit'] != run['commit']:
+      return r
+  return None
+
+
+def compare_runs(base, run, threshold=THRESHOLD):
+  '''log each stage of `run` against `base`, returns the regressions'''
+  regressions = []
+  for name, new in run['stages'].items():
+    old = base['stages'].get(name)
+    if not old:
+      l.info(f'{name:<28} {new["seconds"]:9.3f} s {new["peak_mib"]:9.1f} MiB (new)')
+      continue
+    flags = []
+    if (new['seconds'] > old['seconds'] * threshold
+        and new['seconds'] - old['seconds'] > MIN_SECONDS):
+      flags.append('slower')
+    if (new['peak_mib'] > old['peak_mib'] * threshold
+        and new['peak_mib'] - old['peak_mib'] > MIN_MIB):
+      flags.append('bigger')
+    ratio = new['seconds'] / old['seconds'] if old['seconds'] else 1
+    (l.warning if flags else l.info)(
+        f'{name:<28} {old["seconds"]:9.3f} -> {new["seconds"]:9.3f} s ({ratio:.2f}x) '
+        f'{old["peak_mib"]:7.1f} -> {new["peak_mib"]:7.1f} MiB {" ".join(flags)}')
+    if flags:
+      regressions.append(name)
+  return regressions
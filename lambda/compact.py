@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import re
+import time
+import logging as l
+from schema import get_db, get_state, set_state, DBNAME
+from dbwriter import checkpoint
+
+
+# how many dumps of a url to keep as they age: `age:every` tiers, e.g. one
+# per hour for the first 30 days and one per day after that
+RETENTION = '0:1h,30d:1d'
+# on_event only compacts when this is set, every COMPACT_INTERVAL seconds
+AUTO_COMPACT = 'AUTO_COMPACT' in os.environ
+COMPACT_INTERVAL = 7 * 86400
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# each dump with the first one of the run of identical extractions of its url
+# it belongs to, and what the run's first row takes over from the others
+DUMP_RUNS_SQL = '''
+CREATE TEMP TABLE dump_runs AS
+WITH marked AS (
+  SELECT id, url, timestamp, coalesce(last_seen, timestamp) AS seen,
+    etag, last_modified,
+    status IS NOT lag(status) OVER w OR extracted IS NOT lag(extracted) OVER w AS starts
+  FROM dumps
+  WINDOW w AS (PARTITION BY url ORDER BY timestamp, id)
+), numbered AS (
+  SELECT *, sum(starts) OVER (PARTITION BY url ORDER BY timestamp, id) AS run
+  FROM marked
+)
+SELECT id, first_value(id) OVER r AS keep, count(*) OVER r AS n,
+  max(seen) OVER r AS seen,
+  last_value(etag) OVER r AS etag, last_value(last_modified) OVER r AS last_modified
+FROM numbered
+WINDOW r AS (PARTITION BY url, run ORDER BY timestamp, id
+  ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+'''
+
+# all but the latest dump of each url and status in every `every` seconds,
+# out of those pulled between `since` and `until`. buckets are in local time
+# like the days of the price history, so its last price of each day is kept
+THINNED_DUMPS_SQL = '''
+SELECT id FROM (
+  SELECT id, row_number() OVER (
+    PARTITION BY url, status,
+      CAST(strftime('%s', timestamp, 'unixepoch', 'localtime') / :every AS INTEGER)
+    ORDER BY timestamp DESC, id DESC) AS n
+  FROM dumps
+  WHERE timestamp >= :since AND timestamp < :until
+)
+WHERE n > 1
+'''
+
+
+def parse_duration(s) -> int:
+  m = re.fullmatch(r'(\d+)([smhd]?)', s.strip())
+  if not m:
+    raise ValueError(f'bad duration {s!r}')
+  return int(m[1]) * UNITS[m[2] or 's']
+
+
+def parse_retention(s) -> list[tuple[int, int]]:
+  '''(age, every) tiers of a retention policy, youngest first'''
+  tiers = []
+  for tier in s.split(','):
+    age, every = tier.split(':')
+    tiers.append((parse_duration(age), parse_duration(every)))
+  return sorted(tiers)
+
+
+def drop_dumps(c, select_sql, params=()):
+  '''delete the dumps `select_sql` selects the ids of, with their observations'''
+  c.execute('''DELETE FROM dropped_dumps''')
+  c.execute(f'''INSERT INTO dropped_dumps {select_sql}''', params)
+  c.execute('''
+      DELETE FROM observations
+      WHERE dump_id IN (SELECT id FROM dropped_dumps)''')
+  c.execute('''DELETE FROM dumps WHERE id IN (SELECT id FROM dropped_dumps)''')
+  return c.rowcount
+
+
+def thin_dumps(c, tiers, now):
+  '''drop dumps beyond what the retention `tiers` keep. the latest dump of a
+  url is the latest of its bucket, so it is always kept'''
+  n = 0
+  for i, (age, every) in enumerate(tiers):
+    until = now - age
+    since = now - tiers[i + 1][0] if i + 1 < len(tiers) else 0
+    n += drop_dumps(c, THINNED_DUMPS_SQL,
+        {'every': every, 'since': since, 'until': until})
+  return n
+
+
+def collapse_dumps(c):
+  '''merge each run of consecutive dumps of a url with the same extraction
+  into its first one, seen until the last one was'''
+  c.execute(DUMP_RUNS_SQL)
+  c.execute('''
+      UPDATE dumps SET last_seen = r.seen,
+        etag = coalesce(r.etag, dumps.etag),
+        last_modified = coalesce(r.last_modified, dumps.last_modified)
+      FROM dump_runs r
+      WHERE dumps.id = r.id AND r.id = r.keep AND r.n > 1''')
+  n = drop_dumps(c, '''SELECT id FROM dump_runs WHERE id != keep''')
+  c.execute('''DROP TABLE dump_runs''')
+  return n
+
+
+def db_size(path=DBNAME) -> int:
+  return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def compaction_due(c) -> bool:
+  return time.time() - get_state(c, 'last_compacted', 0) > COMPACT_INTERVAL
+
+
+def compact_dumps(args):
+  '''shrink the dumps table: thin out old dumps by the retention policy,
+  collapse runs of identical extractions, then vacuum the db'''
+  conn, c = get_db()
+  tiers = parse_retention(args.retention)
+  before = db_size()
+  now = time.time()
+
+  c.execute('''CREATE TEMP TABLE dropped_dumps (id INTEGER PRIMARY KEY)''')
+  c.execute('''BEGIN''')
+  thinned = thin_dumps(c, tiers, now)
+  collapsed = collapse_dumps(c)
+  c.execute('''
+      DELETE FROM bodies WHERE hash NOT IN (
+        SELECT body_hash FROM dumps WHERE body_hash IS NOT NULL)''')
+  bodies = c.rowcount
+  l.info(f'Thinned {thinned} dumps, collapsed {collapsed} unchanged dumps, '
+      f'dropped {bodies} page bodies')
+  if args.dry_run:
+    conn.rollback()
+    return
+
+  set_state(c, 'last_compacted', now)
+  # vacuuming renumbers the rows of tables without an integer primary key,
+  # so a replica can't take it as a segment
+  set_state(c, 'rebase_replica', 1)
+  conn.commit()
+  c.execute('''DROP TABLE dropped_dumps''')
+  c.execute('''VACUUM''')
+  conn.close()
+  checkpoint(DBNAME)
+
+  after = db_size()
+  l.info(f'Compacted {DBNAME} from {before} to {after} bytes '
+      f'({(before - after) / 2**20:.1f} MiB reclaimed)')
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# shared by lambda/ and houses/, where it is symlinked
+import os
+import sqlite3
+import logging as l
+
+
+# WAL only syncs on checkpoints with synchronous=NORMAL, and doesn't block
+# readers while writing. a negative cache_size is in KiB
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16384,
+    }
+BATCH_SIZE = 1000
+
+
+def connect(path, pragmas=PRAGMAS):
+  '''open the db at `path` tuned for writing'''
+  conn = sqlite3.connect(path)
+  for k, v in pragmas.items():
+    conn.execute(f'''PRAGMA {k} = {v}''')
+  return conn
+
+
+def checkpoint(path):
+  '''fold the WAL back into the db file, so the file alone can be copied'''
+  conn = sqlite3.connect(path)
+  conn.execute('''PRAGMA wal_checkpoint(TRUNCATE)''')
+  conn.close()
+
+
+def discard_wal(path):
+  '''drop the WAL of a db file that was replaced, it would corrupt the new one'''
+  for ext in ('-wal', '-shm'):
+    if os.path.exists(path + ext):
+      os.remove(path + ext)
+
+
+class Writer:
+  '''unit of work: buffers rows to write, and flushes them with executemany
+  in one transaction once `batch_size` are pending and on exit. statements
+  run grouped, in the order each was first added'''
+  def __init__(self, conn, batch_size=BATCH_SIZE):
+    self.conn = conn
+    self.batch_size = batch_size
+    self.pending = {}
+    self.n = 0
+    self.written = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *exc):
+    if exc_type is None:
+      self.flush()
+
+  def add(self, sql, values):
+    self.pending.setdefault(sql, []).append(values)
+    self.n += 1
+    if self.n >= self.batch_size:
+      self.flush()
+
+  def add_many(self, sql, rows):
+    for values in rows:
+      self.add(sql, values)
+
+  def flush(self):
+    if not self.n:
+      return
+    c = self.conn.cursor()
+    if not self.conn.in_transaction:
+      c.execute('''BEGIN''')
+    try:
+      for sql, rows in self.pending.items():
+        c.executemany(sql, rows)
+    except Exception:
+      self.conn.rollback()
+      raise
+    finally:
+      pending, self.pending, self.n = self.n, {}, 0
+    self.conn.commit()
+    self.written += pending
+    l.debug(f'Wrote {pending} rows')
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import json
+import hashlib
+from urllib.parse import urlparse
+import soupsieve as sv
+from bs4 import BeautifulSoup, SoupStrainer
+from schema import decompress_body
+
+# lxml is much faster at tokenizing the page, but optional
+try:
+  import lxml
+  PARSER = 'lxml'
+except ImportError:
+  PARSER = 'html.parser'
+
+
+EXTRACTORS = {}
+
+
+def register_extractor(host):
+  '''register extractor class for pages on `host` and its subdomains'''
+  def wrapper(cls):
+    EXTRACTORS[host] = cls()
+    return cls
+  return wrapper
+
+
+def get_extractor(url):
+  '''find the extractor registered for the host of `url`'''
+  parts = (urlparse(url).hostname or '').split('.')
+  for i in range(len(parts) - 1):
+    e = EXTRACTORS.get('.'.join(parts[i:]))
+    if e:
+      return e
+  return None
+
+
+def get_fingerprint(data):
+  '''hash of the extracted pricing data of a dump'''
+  return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def extract_row(row):
+  '''extract a (id, url, body, codec, data) dump row where the body is
+  either inline or compressed in `data`, picklable for process pools'''
+  id, url, body, codec, blob = row
+  if blob is not None:
+    body = decompress_body(blob, codec)
+  e = get_extractor(url)
+  data = e.extract(body) if e else None
+  return json.dumps(data), get_fingerprint(data), e and e.version, id
+
+
+class Extractor:
+  '''pulls unit data out of a site's pages'''
+  # bump when a change would extract different data from the same page
+  version = 1
+  # only this part of the page is turned into a tree
+  strainer = None
+  # text inside the opening tag of that part, everything before it is skipped
+  anchor = None
+
+  def parse(self, body):
+    if self.anchor:
+      i = body.find(self.anchor)
+      if i >= 0:
+        body = body[body.rfind('<', 0, i):]
+    return BeautifulSoup(body, features=PARSER, parse_only=self.strainer)
+
+  def extract(self, body):
+    raise NotImplementedError
+
+
+@register_extractor('apartments.com')
+class ApartmentsExtractor(Extractor):
+  strainer = SoupStrainer(id='pricingView')
+  anchor = 'id="pricingView"'
+  models_sel = sv.compile('#pricingView > div[data-tab-content-id="bed1"] .pricingGridItem')
+  model_name_sel = sv.compile('.priceBedRangeInfo .modelName')
+  units_sel = sv.compile('.unitContainer')
+  hidden_sel = sv.compile('.screenReaderOnly')
+  unit_sel = sv.compile('.unitColumn')
+  price_sel = sv.compile('.pricingColumn')
+  sqft_sel = sv.compile('.sqftColumn')
+  available_sel = sv.compile('.availableColumn')
+
+  def extract(self, body):
+    bs = self.parse(body)
+    res = []
+    for m in self.models_sel.select(bs):
+      model_name = self.model_name_sel.select_one(m).text.strip()
+      for u in self.units_sel.select(m):
+        # remove these tags
+        for s in self.hidden_sel.select(u):
+          s.extract()
+
+        res.append({
+          'model': model_name,
+          'unit': self.unit_sel.select_one(u).text.strip(),
+          'price': int(self.price_sel.select_one(u).text.strip()
+            .replace('$', '').replace(',', '')
+            ),
+          'sqft': int(self.sqft_sel.select_one(u).text.strip()
+            .replace(',', '')
+            ),
+          'available': self.available_sel.select_one(u).text.strip(),
+          })
+    return res
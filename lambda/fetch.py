@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import time
+import threading
+import logging as l
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 12_3_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.3 Safari/605.1.15'
+    }
+MAX_WORKERS = 8
+# requests per second allowed against a single host, and how many can burst
+HOST_RATE = 1
+HOST_BURST = 2
+TIMEOUT = (5, 30)
+RETRIES = 3
+BACKOFF = 1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+  '''thread safe token bucket, `acquire` blocks until a token is available'''
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+class Fetcher:
+  '''bounded concurrent fetcher with a shared keep-alive session and
+  per-host throttling'''
+  def __init__(self, max_workers=MAX_WORKERS, rate=HOST_RATE,
+      burst=HOST_BURST, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+    self.max_workers = max_workers
+    self.rate = rate
+    self.burst = burst
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+
+    self.session = requests.Session()
+    self.session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+
+    self.buckets = {}
+    self.buckets_lock = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.session.close()
+
+  def bucket(self, url):
+    host = urlparse(url).hostname
+    with self.buckets_lock:
+      if host not in self.buckets:
+        self.buckets[host] = TokenBucket(self.rate, self.burst)
+      return self.buckets[host]
+
+  def get(self, url, **kwargs):
+    '''GET `url` respecting the host's rate limit, retrying transient
+    failures with exponential backoff'''
+    bucket = self.bucket(url)
+    for attempt in range(self.retries + 1):
+      bucket.acquire()
+      last = attempt == self.retries
+      try:
+        with metrics.timed('fetch_seconds', url):
+          r = self.session.get(url, timeout=self.timeout, **kwargs)
+        metrics.count('fetches')
+        metrics.count('fetch_bytes', len(r.content))
+      except (requests.ConnectionError, requests.Timeout) as e:
+        if last:
+          raise
+        l.warning(f'Fetching {url} failed ({e}), retrying...')
+      else:
+        if r.status_code not in RETRY_STATUSES or last:
+          return r
+        l.warning(f'Fetching {url} returned {r.status_code}, retrying...')
+      time.sleep(self.backoff * 2 ** attempt)
+
+  def map(self, func, items):
+    '''run `func(self, item)` over `items` on the pool, yielding
+    (item, result, error) in completion order'''
+    with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+      futures = {ex.submit(func, self, i): i for i in items}
+      for f in as_completed(futures):
+        i = futures[f]
+        try:
+          yield i, f.result(), None
+        except Exception as e:
+          yield i, None, e
+
@@ -5,109 +5,177 @@ import json
 import tempfile
 from subprocess import check_output
 import logging as l
-from termcolor import colored
 from datetime import datetime as dt
 from datetime import timedelta
-from update import extract_dump
 from sheets import get_google_sheet, get_apartments_from_google_sheets
-from schema import Dump, Notification, NotificationAction, get_db
-from notify import create_email, send_email, check_notify_price_change
-
-
-EMAIL_RECIPIENTS = None
-if 'EMAIL_RECIPIENTS' in os.environ:
-  EMAIL_RECIPIENTS = os.environ['EMAIL_RECIPIENTS'].split(',')
-else:
-  with open('secrets/recipients') as f:
-    EMAIL_RECIPIENTS = f.read().strip().split('\n')
+from schema import get_db, get_state, set_state, reset_price_history, CHANGED_OBSERVATIONS_SQL
+import metrics
+
+
+def get_dump_times(timestamp, last_seen):
+  '''times a dump was current: when it was pulled, plus one per day after
+  that it was pulled again unchanged, up to `last_seen`'''
+  start = dt.fromtimestamp(timestamp)
+  times = [start]
+  if last_seen:
+    end = dt.fromtimestamp(last_seen)
+    for n in range(1, (end.date() - start.date()).days + 1):
+      day = start.date() + timedelta(days=n)
+      times.append(min(end, dt.combine(day, dt.max.time())))
+  return times
+
+
+def fold_price_history(conn, c):
+  '''fold units of dumps pulled or seen again since the last run into the
+  per day price aggregate'''
+  watermark = get_state(c, 'history_watermark', 0)
+  since = dt.fromtimestamp(watermark).date()
+
+  prices, n = [], 0
+  for url, model, unit, timestamp, last_seen, price in c.execute(
+      CHANGED_OBSERVATIONS_SQL, (watermark,)):
+    # days before the watermark were folded already
+    for t in get_dump_times(timestamp, last_seen):
+      if t.date() >= since:
+        prices.append((url, model, unit, t.date().isoformat(), price,
+          timestamp, t.timestamp()))
+    watermark = max(watermark, last_seen or timestamp)
+    n += 1
+
+  # leave the db untouched when there is nothing new, so it isn't uploaded
+  if n:
+    c.executemany('''
+        INSERT INTO daily_prices (url, model, unit, day, price, timestamp, seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (url, model, unit, day) DO UPDATE SET
+          price = excluded.price, timestamp = excluded.timestamp, seen = excluded.seen
+        WHERE excluded.timestamp >= daily_prices.timestamp
+        ''', prices)
+    set_state(c, 'history_watermark', watermark)
+    conn.commit()
+  metrics.count('observations_folded', n)
+  l.info(f'Folded {n} observations into price history')
+
+
+def rebuild_price_history(args):
+  '''recompute the per day price aggregate from all observations'''
+  conn, c = get_db()
+  reset_price_history(c)
+  fold_price_history(conn, c)
 
 
 def get_price_data(apmts, conn, c):
-  hist, unit_data = {}, {}
+  fold_price_history(conn, c)
+
+  indexes = {}
   for i, a in enumerate(apmts):
-    res = c.execute('''
-        SELECT t1.*
-        FROM dumps t1
-        WHERE status = 200 AND url = ?
-        ORDER BY timestamp
-        ''', (a['url'],))
-
-    for r in res:
-      d = Dump(*r)
-      data = json.loads(d.extracted)
-
-      for u in data:
-        k = (i, u['model'], u['unit'])
-        if k not in unit_data:
-          unit_data[k] = u
-
-        if k not in hist:
-          hist[k] = []
-        # elif hist[k][-1][0] == u['price']:
-        #   continue
-
-        hist[k].append((
-          u['price'],
-          dt.fromtimestamp(d.timestamp),
-          ))
+    indexes.setdefault(a['url'], []).append(i)
+
+  hist = {}
+  for url, model, unit, price, seen in c.execute('''
+      SELECT url, model, unit, price, seen FROM daily_prices ORDER BY day'''):
+    for i in indexes.get(url, []):
+      hist.setdefault((i, model, unit), []).append((price, dt.fromtimestamp(seen)))
 
   hdata = sorted(hist.items(), key=lambda p: p[0])
-  return hdata, unit_data
+  return hdata
 
 
-def get_price_history(conn, c):
-  ''''''
-  apmts = get_apartments_from_google_sheets(local=True)
-  hdata, unit_data = get_price_data(apmts, conn, c)
+def pivot_price_data(apmts, hdata):
+  '''grid of each unit's last price of each day, with a header row of dates
+  and a first column of unit names'''
+  min_date = min(h[0][1] for k, h in hdata).date()
+  max_date = max(h[-1][1] for k, h in hdata).date()
+  ndays = (max_date - min_date).days + 1
+  min_day = min_date.toordinal()
 
-  dates = [t.date() for k, h in hdata for p, t in h]
-  min_date, max_date = min(dates), max(dates)
-  vals = [[None for n in range((max_date - min_date).days + 2)]
-      for _ in range(len(hdata) + 1)]
-
-  notifications = []
-  for j, (k, h) in enumerate(hdata):
+  vals = [[None] + [
+    (min_date + timedelta(days=n)).strftime('%b %-d %Y') for n in range(ndays)]]
+  for k, h in hdata:
     index, model, unit = k
-    vals[j+1][0] = f'{apmts[index]["name"]} - {model}/{unit}'
-
-  for n in range((max_date - min_date).days + 1):
-    d = min_date + timedelta(days=n)
-    vals[0][n+1] = d.strftime('%b %-d %Y')
+    row = [f'{apmts[index]["name"]} - {model}/{unit}'] + [None] * ndays
+    # history is in time order, so the last write to a day is its last price
+    for p, t in h:
+      row[t.toordinal() - min_day + 1] = p
+    vals.append(row)
 
-    for j, (k, h) in enumerate(hdata):
-      p, t = next(((p, t) for p, t in h[::-1] if t.date() == d), (None, None))
-      vals[j+1][n+1] = p
+  return vals
 
-      if d == max_date and p is not None:
-        nf = check_notify_price_change(conn, c, apmts, unit_data, k, p, t)
-        if nf:
-          notifications.append(nf)
 
-  return vals, notifications
+def get_price_history(conn, c):
+  ''''''
+  apmts = get_apartments_from_google_sheets(local=True)
+  with metrics.span('fold'):
+    hdata = get_price_data(apmts, conn, c)
+  with metrics.span('pivot', units=len(hdata)):
+    return pivot_price_data(apmts, hdata)
+
+
+def diff_sheet_ranges(old, new):
+  '''blocks of cells in grid `new` that differ from grid `old`, as
+  (row, column, values). cells only in `old` are cleared'''
+  nrows = max(len(old), len(new))
+  ncols = max([len(r) for r in old + new] or [0])
+  cell = lambda g, i, j: g[i][j] if i < len(g) and j < len(g[i]) else None
+
+  # runs of changed columns in each row
+  runs = []
+  for i in range(nrows):
+    row_runs, start = [], None
+    for j in range(ncols + 1):
+      changed = j < ncols and cell(old, i, j) != cell(new, i, j)
+      if changed and start is None:
+        start = j
+      elif not changed and start is not None:
+        row_runs.append((start, j))
+        start = None
+    runs.append(row_runs)
+
+  # merge the same run on consecutive rows into one block, so a new day
+  # column or new unit rows are a single range
+  ranges, open_runs = [], {}
+  for i in range(nrows + 1):
+    cur = runs[i] if i < nrows else []
+    for run in [r for r in open_runs if r not in cur]:
+      r0, (c0, c1) = open_runs.pop(run), run
+      ranges.append((r0, c0,
+        [[cell(new, r, c) for c in range(c0, c1)] for r in range(r0, i)]))
+    for run in cur:
+      open_runs.setdefault(run, i)
+  return ranges
 
 
 def sync_price_history(args):
   '''sync price history by day to google sheets'''
   conn, c = get_db()
-  vals, notifications = get_price_history(conn, c)
+  vals = get_price_history(conn, c)
 
   if not args.dry_run:
     l.info('Updating spreadsheet')
-    sp = get_google_sheet()
-    s = sp.sheets[1]
-    s.get_data_range().set_value(None)
-
-    dr = s.get_range(row=1, column=1,
-        number_of_row=len(vals), number_of_column=len(vals[0]))
-    dr.set_values(vals)
-    sp.commit()
+    with metrics.span('sheets_push'):
+      sp = get_google_sheet()
+      s = sp.sheets[1]
+
+      # only push cells that changed since what was last written
+      snapshot = get_state(c, 'sheet_snapshot')
+      if snapshot is None or args.force:
+        s.get_data_range().set_value(None)
+        ranges = [(0, 0, vals)]
+      else:
+        ranges = diff_sheet_ranges(json.loads(snapshot), vals)
 
-    if len(notifications):
-      l.info(f'Sending {len(notifications)} notifications')
+      for row, column, block in ranges:
+        dr = s.get_range(row=row + 1, column=column + 1,
+            number_of_row=len(block), number_of_column=len(block[0]))
+        dr.set_values(block, batch_to=sp)
+      sp.commit()
+    metrics.count('sheet_ranges', len(ranges))
+    metrics.count('sheet_cells', sum(len(b) * len(b[0]) for _, _, b in ranges))
+    l.info(f'Updated {len(ranges)} ranges of the spreadsheet')
 
-      send_email(EMAIL_RECIPIENTS, notifications)
-      for n in notifications:
-          n.insert(conn, c)
+    if ranges:
+      set_state(c, 'sheet_snapshot', json.dumps(vals))
+      conn.commit()
 
 
 def filter_lowest_priced_units(vals):
@@ -135,7 +203,7 @@ def filter_lowest_priced_units(vals):
 def view_price_history(args):
   ''''''
   conn, c = get_db()
-  vals, notifications = get_price_history(conn, c)
+  vals = get_price_history(conn, c)
 
   vals = filter_lowest_priced_units(vals)
 
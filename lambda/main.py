@@ -1,42 +1,90 @@
 #!/usr/bin/env python3
+import time
+STARTED = time.monotonic()
 import os
 import sys
 import json
 import argparse
 import logging as l
-from history import sync_price_history, view_price_history
+from history import sync_price_history, view_price_history, rebuild_price_history
 from update import update_dumps, reextract_dumps
-from schema import get_db, get_db_hash, DBNAME
+from schema import get_db, ChangeTracker, archive_bodies, backfill_observations, check_query_plans, DBNAME
 from sheets import SHEETS_DATA_FN
+from notify import send_notifications
+from store import get_store, download_cached, upload_cached, set_cached_generation
+from dbwriter import checkpoint
+from replicate import pull_replica, push_replica, set_local_manifest, restore_replica, REPLICATE
+from compact import compact_dumps, compaction_due, RETENTION, AUTO_COMPACT
+import metrics
+
+# seconds on_event may take before running actions, imports included
+STARTUP_BUDGET = 5
+IMPORT_TIME = time.monotonic() - STARTED
+PROFILE_DIR = (
+    'data/profile' if 'GCS_BUCKET_NAME' not in os.environ else
+    '/tmp/profile')
+cold_start = True
 
 
 def on_event(event, context):
-  # setup logging
-  root = l.getLogger()
-  handler = l.StreamHandler(sys.stdout)
-  formatter = CloudLoggingFormatter(fmt="[%(name)s] %(message)s")
-  handler.setFormatter(formatter)
-  root.addHandler(handler)
-  root.setLevel(l.DEBUG)
+  global cold_start
+  start = time.monotonic()
+  if cold_start:
+    # setup logging, the root logger outlives warm invocations
+    root = l.getLogger()
+    handler = l.StreamHandler(sys.stdout)
+    formatter = CloudLoggingFormatter(fmt="[%(name)s] %(message)s")
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+    root.setLevel(l.DEBUG)
+
+  # get db from storage, unless this instance has the latest copy already
+  store = get_store()
+  db_name, sheets_name = os.path.basename(DBNAME), os.path.basename(SHEETS_DATA_FN)
+  manifest = db_gen = None
+  with metrics.span('download'):
+    if REPLICATE:
+      manifest = pull_replica(store, DBNAME)
+    if manifest is None:
+      # the whole db, which is also what a new replica starts from
+      db_gen = download_cached(store, db_name, DBNAME)
+    download_cached(store, sheets_name, SHEETS_DATA_FN)
 
-  # get db from storage
-  from google.cloud import storage
-  s = storage.Client()
-  bucket = s.get_bucket(os.environ['GCS_BUCKET_NAME'])
-  l.info(f'Downloading {os.path.basename(DBNAME)} + {os.path.basename(SHEETS_DATA_FN)} from GCS...')
-  db_blob = bucket.blob(os.path.basename(DBNAME))
-  db_blob.download_to_filename(DBNAME)
-  sheets_blob = bucket.blob(os.path.basename(SHEETS_DATA_FN))
-  sheets_blob.download_to_filename(SHEETS_DATA_FN)
+  startup = time.monotonic() - start + (IMPORT_TIME if cold_start else 0)
+  (l.warning if startup > STARTUP_BUDGET else l.info)(
+      f'Started in {startup:.2f}s ({"cold" if cold_start else "warm"}, '
+      f'budget {STARTUP_BUDGET}s)')
+  cold_start = False
 
-  h = get_db_hash()
+  # the local copy diverges from the store until uploaded
+  set_cached_generation(DBNAME, None)
+  set_local_manifest(DBNAME, None)
+  tracker = ChangeTracker()
   main(['update'])
   main(['history'])
-  newh = get_db_hash()
-  if newh != h:
-    l.info(f'DB updated with hash:{newh}. Uploading to GCS...')
-    db_blob.upload_from_filename(DBNAME)
-    sheets_blob.upload_from_filename(SHEETS_DATA_FN)
+  if AUTO_COMPACT:
+    conn, c = get_db()
+    due = compaction_due(c)
+    conn.close()
+    if due:
+      main(['compact'])
+  changed = tracker.changed()
+  tracker.close()
+  if changed or (REPLICATE and manifest is None):
+    l.info('DB updated. Uploading...')
+    with metrics.span('upload'):
+      if REPLICATE:
+        push_replica(store, DBNAME, manifest)
+      else:
+        checkpoint(DBNAME)
+        upload_cached(store, DBNAME, db_name)
+      upload_cached(store, SHEETS_DATA_FN, sheets_name)
+  elif REPLICATE:
+    set_local_manifest(DBNAME, manifest)
+  else:
+    set_cached_generation(DBNAME, db_gen)
+  l.info(f'Run took {time.monotonic() - start:.2f}s')
+  metrics.report()
 
 
 class CloudLoggingFormatter(l.Formatter):
@@ -48,6 +96,8 @@ class CloudLoggingFormatter(l.Formatter):
         'message': s,
         'severity': r.levelname,
         'timestamp': {'seconds': int(r.created), 'nanos': 0},
+        # metrics, as fields of the structured log entry
+        **getattr(r, 'fields', {}),
       }
     )
 
@@ -57,8 +107,15 @@ def main(argv=None):
       'update': update_dumps,
       'reextract': reextract_dumps,
       'history': sync_price_history,
+      'notify': send_notifications,
+      'rebuild-history': rebuild_price_history,
       'view-history': view_price_history,
-      'migrate': lambda args: get_db(migrate=True),
+      'migrate': lambda args: get_db(),
+      'check-plans': check_query_plans,
+      'archive-bodies': archive_bodies,
+      'backfill-observations': backfill_observations,
+      'restore': restore_replica,
+      'compact': compact_dumps,
       }
 
   parser = argparse.ArgumentParser(description='apartment hunter')
@@ -67,10 +124,24 @@ def main(argv=None):
       action="store_true", help='use local sheets data')
   parser.add_argument('--dry-run',
       action="store_true", help='dont make changes')
+  parser.add_argument('--force',
+      action="store_true",
+      help='reextract dumps even if extractor is current, rewrite whole sheet, '
+        'restore from the base instead of new segments')
+  parser.add_argument('--jobs',
+      type=int, help='processes to reextract with (default: cpu count)')
+  parser.add_argument('--profile',
+      action="store_true", help=f'write cProfile and tracemalloc output to {PROFILE_DIR}')
+  parser.add_argument('--retention', default=RETENTION,
+      help='dumps to keep when compacting, as age:every tiers, '
+        'e.g. 0:1h,30d:1d keeps one an hour, and one a day after 30 days')
   args = parser.parse_args(argv) if argv else parser.parse_args()
-  action_funcs[args.action](args)
+  with (metrics.profile(args.action, PROFILE_DIR) if args.profile else metrics.NULL):
+    with metrics.span(args.action):
+      action_funcs[args.action](args)
 
 
 if __name__ == "__main__":
   l.basicConfig(level=l.INFO)
   main()
+  metrics.report()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import os
+import time
+import threading
+import logging as l
+from contextlib import contextmanager, nullcontext
+
+
+# timings and counts of a run, logged as structured fields. when disabled
+# every call returns right away
+ENABLED = os.environ.get('METRICS', '1') == '1'
+# upper bounds in seconds of the buckets timings are counted in
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+NULL = nullcontext()
+# phases the current span is nested in, spans only run on the main thread
+phases = []
+# counters and timings of the run, also updated from fetch threads
+counters = {}
+timings = {}
+lock = threading.Lock()
+
+
+@contextmanager
+def _span(name, fields):
+  phases.append(name)
+  path = '/'.join(phases)
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    t = time.perf_counter() - start
+    phases.pop()
+    l.info(f'{path} took {t:.3f}s',
+        extra={'fields': {'span': path, 'seconds': round(t, 4), **fields}})
+
+
+def span(name, **fields):
+  '''time a phase of the run, logged when it ends'''
+  return _span(name, fields) if ENABLED else NULL
+
+
+@contextmanager
+def _timed(name, label):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    observe(name, time.perf_counter() - start, label)
+
+
+def timed(name, label=None):
+  '''time the block into the histogram of `name`, per `label`'''
+  return _timed(name, label) if ENABLED else NULL
+
+
+def observe(name, value, label=None):
+  if ENABLED:
+    with lock:
+      timings.setdefault(name, {}).setdefault(label, []).append(value)
+
+
+def count(name, n=1):
+  if ENABLED:
+    with lock:
+      counters[name] = counters.get(name, 0) + n
+
+
+def percentile(values, p):
+  return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(values):
+  values = sorted(values)
+  return {
+      'count': len(values),
+      'sum': round(sum(values), 4),
+      'p50': round(percentile(values, 0.5), 4),
+      'p90': round(percentile(values, 0.9), 4),
+      'max': round(values[-1], 4),
+      }
+
+
+def histogram(values):
+  '''count of values in each of BUCKETS, keyed by its bound'''
+  buckets = dict.fromkeys(map(str, BUCKETS), 0)
+  for v in values:
+    buckets[str(next(b for b in BUCKETS if v <= b))] += 1
+  return buckets
+
+
+def report():
+  '''log the counters and a histogram of each timing, overall and per label,
+  then start over'''
+  if not ENABLED:
+    return
+  with lock:
+    run_timings, run_counters = dict(timings), dict(counters)
+    timings.clear()
+    counters.clear()
+
+  for name, by_label in sorted(run_timings.items()):
+    values = [v for vs in by_label.values() for v in vs]
+    s = summarize(values)
+    l.info(f'{name}: {s["count"]} in {s["sum"]:.3f}s, p50 {s["p50"]:.3f}s, '
+        f'p90 {s["p90"]:.3f}s, max {s["max"]:.3f}s',
+        extra={'fields': {'metric': name, **s, 'histogram': histogram(values),
+          'labels': {str(k): summarize(vs) for k, vs in by_label.items()
+            if k is not None}}})
+  if run_counters:
+    l.info(', '.join(f'{k}: {v}' for k, v in sorted(run_counters.items())),
+        extra={'fields': {'counters': run_counters}})
+
+
+@contextmanager
+def profile(name, out_dir):
+  '''profile the block with cProfile and tracemalloc, writing
+  `{name}.prof` and `{name}.mem.txt` to `out_dir`'''
+  import cProfile
+  import pstats
+  import tracemalloc
+
+  os.makedirs(out_dir, exist_ok=True)
+  prefix = os.path.join(out_dir, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}')
+  tracemalloc.start(25)
+  prof = cProfile.Profile()
+  prof.enable()
+  try:
+    yield
+  finally:
+    prof.disable()
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    prof.dump_stats(prefix + '.prof')
+    with open(prefix + '.mem.txt', 'w') as f:
+      f.write(f'current {current} bytes, peak {peak} bytes\n\n')
+      for s in snapshot.statistics('traceback')[:25]:
+        f.write(f'{s}\n' + '\n'.join(s.traceback.format()) + '\n\n')
+    stats = pstats.Stats(prof).sort_stats('cumulative')
+    top = [f'{stats.stats[k][3]:8.3f}s {pstats.func_std_string(k)}'
+        for k in stats.fcn_list[:10]]
+    l.info(f'Profiled {name} into {prefix}.prof and {prefix}.mem.txt, '
+        f'peak {peak / 2**20:.1f} MiB. top cumulative:\n' + '\n'.join(top))
@@ -1,49 +1,67 @@
 #!/usr/bin/env python3
+import os
 import smtplib
 import json
 import time
-from schema import Notification, NotificationAction
-from bs4 import BeautifulSoup, Tag
+import logging as l
+from schema import Notification, NotificationAction, get_db
 from email.message import EmailMessage
+import metrics
 
 
-with open('secrets/email-creds') as f:
-  lines = f.readlines()
-  EMAIL_SENDER = lines[0].strip()
-  EMAIL_PASSWORD = lines[1].strip()
-
-
-def check_notify_price_change(conn, c, apmts, unit_data, k, p, t):
-  '''notify user on price change'''
-  index, model, unit = k
-  r = c.execute('''
-      SELECT *
-      FROM notifications
-      WHERE name = ? AND unit = ?
-      ORDER BY last_notified DESC
-      LIMIT 1
-      ''', (apmts[index]['name'], unit)).fetchone()
-
-  action = None
-  data = {
-      'price': p,
-      'sqft': unit_data[k]['sqft'],
-      'available': unit_data[k]['available'],
-      }
-  if r:
-    n = Notification(*r)
-    nd = json.loads(n.data)
-    if nd['price'] != p:
-      data['last_price'] = nd['price']
-      action = (
-          NotificationAction.PRICE_INCREASE if p > nd['price'] else
-          NotificationAction.PRICE_DECREASE)
-  else:
-    action = NotificationAction.ADDED
-
-  if action:
-    return Notification(0, apmts[index]['name'], unit, int(t.timestamp()), action.name, json.dumps(data))
-  return None
+EMAIL_SENDER = EMAIL_PASSWORD = None
+if 'EMAIL_SENDER' in os.environ:
+  EMAIL_SENDER = os.environ['EMAIL_SENDER']
+  EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD', '')
+else:
+  with open('secrets/email-creds') as f:
+    lines = f.readlines()
+    EMAIL_SENDER = lines[0].strip()
+    EMAIL_PASSWORD = lines[1].strip()
+
+EMAIL_RECIPIENTS = None
+if 'EMAIL_RECIPIENTS' in os.environ:
+  EMAIL_RECIPIENTS = os.environ['EMAIL_RECIPIENTS'].split(',')
+else:
+  with open('secrets/recipients') as f:
+    EMAIL_RECIPIENTS = f.read().strip().split('\n')
+
+SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_TIMEOUT = 30
+# a failed send is retried after RETRY_BACKOFF * 2^attempts seconds
+RETRY_BACKOFF = 600
+MAX_ATTEMPTS = 8
+
+
+def diff_units(name, old, new, t):
+  '''notifications for units added, removed or changing price between the
+  `old` and `new` extracted units of apartment `name`. nothing when `new` is
+  empty, that is a page that failed to extract rather than every unit gone'''
+  if not new:
+    return []
+  old_units = {(u['model'], u['unit']): u for u in old}
+  new_units = {(u['model'], u['unit']): u for u in new}
+
+  notifications = []
+  def notify(action, u, **extra):
+    data = {'price': u['price'], 'sqft': u['sqft'], 'available': u['available'], **extra}
+    notifications.append(Notification(
+      0, name, u['unit'], int(t), action.name, json.dumps(data)))
+
+  for k in sorted(new_units.keys() - old_units.keys()):
+    notify(NotificationAction.ADDED, new_units[k])
+  for k in sorted(old_units.keys() - new_units.keys()):
+    notify(NotificationAction.REMOVED, old_units[k])
+  for k in sorted(new_units.keys() & old_units.keys()):
+    p, last_price = new_units[k]['price'], old_units[k]['price']
+    if p != last_price:
+      notify(
+          NotificationAction.PRICE_INCREASE if p > last_price else
+          NotificationAction.PRICE_DECREASE,
+          new_units[k], last_price=last_price)
+  return notifications
 
 
 def create_email(notifications):
@@ -65,17 +83,93 @@ def create_email(notifications):
   return '\n'.join(msgs)
 
 
-def send_email(recipients, notifications):
-  content = create_email(notifications)
+def queue_notifications(c, recipients, notifications):
+  '''save notifications and queue them in the outbox for each recipient,
+  committed by the caller along with whatever caused them'''
+  Notification.insert_many(None, c, notifications, commit=False)
+  c.executemany('''INSERT INTO outbox (notification_id, recipient) VALUES (?, ?)''',
+      [(n.id, r) for n in notifications for r in recipients])
+
+
+def create_message(recipient, notifications):
   msg = EmailMessage()
-  msg.set_content(content)
+  msg.set_content(create_email(notifications))
   msg['Subject'] = f'{len(notifications)} New Apartment Updates!'
   msg['From'] = EMAIL_SENDER
-  msg['To'] = ', '.join(recipients)
-
-  s = smtplib.SMTP('smtp.gmail.com', 587)
-  s.ehlo()
-  s.starttls()
-  s.login(EMAIL_SENDER, EMAIL_PASSWORD)
-  s.send_message(msg)
-  s.quit()
+  msg['To'] = recipient
+  return msg
+
+
+def connect_smtp():
+  s = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+  try:
+    s.ehlo()
+    if SMTP_STARTTLS:
+      s.starttls()
+      s.ehlo()
+    if s.has_extn('auth'):
+      s.login(EMAIL_SENDER, EMAIL_PASSWORD)
+  except Exception:
+    s.close()
+    raise
+  return s
+
+
+def dispatch_notifications(conn, c):
+  '''send due notifications from the outbox as one email per recipient over
+  a single connection. failed sends are retried by later runs with backoff'''
+  now = time.time()
+  rows = c.execute('''
+      SELECT o.id, o.recipient, o.attempts, n.*
+      FROM outbox o
+      JOIN notifications n ON n.id = o.notification_id
+      WHERE o.sent IS NULL AND o.next_attempt <= ? AND o.attempts < ?
+      ORDER BY o.recipient, n.id
+      ''', (now, MAX_ATTEMPTS)).fetchall()
+  if not rows:
+    return
+
+  by_recipient = {}
+  for r in rows:
+    by_recipient.setdefault(r[1], []).append((r[0], r[2], Notification(*r[3:])))
+
+  s = None
+  for recipient, queued in by_recipient.items():
+    try:
+      with metrics.timed('smtp_seconds'):
+        s = s or connect_smtp()
+        s.send_message(create_message(recipient, [n for _, _, n in queued]))
+    except (smtplib.SMTPException, OSError) as e:
+      l.error(f'Sending {len(queued)} notifications to {recipient} failed: {e}')
+      c.executemany('''
+          UPDATE outbox SET attempts = ?, next_attempt = ?, error = ?
+          WHERE id = ?
+          ''', [(attempts + 1, now + RETRY_BACKOFF * 2 ** attempts, str(e), id)
+            for id, attempts, _ in queued])
+      for _, attempts, n in queued:
+        if attempts + 1 >= MAX_ATTEMPTS:
+          l.warning(f'Giving up on notification {n.id} to {recipient} '
+              f'after {attempts + 1} attempts: {e}')
+      metrics.count('emails_failed')
+      # SMTPException is an OSError too, but one recipient being refused
+      # leaves the connection usable
+      broken = (isinstance(e, smtplib.SMTPServerDisconnected)
+          or not isinstance(e, smtplib.SMTPException))
+      if s and broken:
+        s.close()
+        s = None
+    else:
+      l.info(f'Sent {len(queued)} notifications to {recipient}')
+      metrics.count('emails_sent')
+      c.executemany('''UPDATE outbox SET sent = ?, error = NULL WHERE id = ?''',
+          [(now, id) for id, _, _ in queued])
+    # commit each recipient, so a crash later doesn't resend to them
+    conn.commit()
+
+  if s:
+    s.quit()
+
+
+def send_notifications(args):
+  conn, c = get_db()
+  dispatch_notifications(conn, c)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import os
+import json
+import sqlite3
+import tempfile
+import logging as l
+from schema import get_state, DBNAME
+from store import get_store
+from dbwriter import discard_wal
+
+
+# ship changes to the db as segments instead of uploading all of it
+REPLICATE = 'REPLICATE' in os.environ
+# the replica is a base snapshot plus numbered segments of rows changed since,
+# listed in order by the manifest
+MANIFEST = 'manifest.json'
+# segments after which the whole db is uploaded again as a new base
+COMPACT_SEGMENTS = 48
+
+CHANGELOG_SQL = '''
+CREATE TABLE IF NOT EXISTS changelog (
+  seq INTEGER PRIMARY KEY,
+  tbl TEXT NOT NULL,
+  row INTEGER NOT NULL,
+  UNIQUE (tbl, row)
+)
+'''
+
+
+def get_tables(c, schema='main'):
+  '''replicated tables of the db attached as `schema`'''
+  return [r[0] for r in c.execute(f'''
+      SELECT name FROM {schema}.sqlite_master
+      WHERE type = 'table' AND name NOT LIKE 'sqlite_%' AND name != 'changelog'
+      ORDER BY name
+      ''')]
+
+
+def enable_changelog(c):
+  '''log the rowid of every row written to a table in `changelog`, until it
+  has been shipped in a segment. tables created later are picked up on the
+  next call, after the schema change has forced a new base'''
+  c.execute(CHANGELOG_SQL)
+  for t in get_tables(c):
+    for op, ref in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+      c.execute(f'''
+          CREATE TRIGGER IF NOT EXISTS changelog_{t}_{op.lower()}
+          AFTER {op} ON {t} BEGIN
+            INSERT OR REPLACE INTO changelog (tbl, row) VALUES ('{t}', {ref}.rowid);
+          END
+          ''')
+
+
+def export_segment(conn, c, path, seq):
+  '''write rows logged up to changelog `seq` to a new db at `path`. rows still
+  there go in a table of the same name with their rowid as `_rowid`, rowids
+  of deleted ones in `_deleted`'''
+  c.execute('''ATTACH DATABASE ? AS seg''', (path,))
+  try:
+    c.execute('''CREATE TABLE seg._deleted (tbl TEXT, row INTEGER)''')
+    tables = set(get_tables(c))
+    for (t,) in c.execute('''SELECT DISTINCT tbl FROM changelog''').fetchall():
+      if t not in tables:
+        continue
+      c.execute(f'''
+          CREATE TABLE seg."{t}" AS
+          SELECT rowid AS _rowid, * FROM main."{t}"
+          WHERE rowid IN (SELECT row FROM changelog WHERE tbl = ? AND seq <= ?)
+          ''', (t, seq))
+      c.execute(f'''
+          INSERT INTO seg._deleted
+          SELECT tbl, row FROM changelog
+          WHERE tbl = ? AND seq <= ? AND row NOT IN (SELECT rowid FROM main."{t}")
+          ''', (t, seq))
+    conn.commit()
+  finally:
+    c.execute('''DETACH DATABASE seg''')
+
+
+def apply_segment(conn, c, path):
+  '''replay a segment written by `export_segment` onto the db'''
+  c.execute('''ATTACH DATABASE ? AS seg''', (path,))
+  try:
+    c.execute('''BEGIN''')
+    for (t,) in c.execute('''SELECT DISTINCT tbl FROM seg._deleted''').fetchall():
+      c.execute(f'''
+          DELETE FROM main."{t}"
+          WHERE rowid IN (SELECT row FROM seg._deleted WHERE tbl = ?)
+          ''', (t,))
+    for t in get_tables(c, 'seg'):
+      if t == '_deleted':
+        continue
+      columns = ', '.join(f'"{r[1]}"' for r in
+          c.execute(f'''PRAGMA seg.table_info("{t}")''').fetchall()[1:])
+      c.execute(f'''
+          INSERT OR REPLACE INTO main."{t}" (rowid, {columns})
+          SELECT _rowid, {columns} FROM seg."{t}"
+          ''')
+    conn.commit()
+  finally:
+    c.execute('''DETACH DATABASE seg''')
+
+
+def manifest_path(path):
+  return path + '.manifest'
+
+
+def get_local_manifest(path):
+  '''manifest of the replica the db at `path` was last in sync with, None if
+  unknown or modified since'''
+  try:
+    with open(manifest_path(path)) as f:
+      return json.load(f) if os.path.exists(path) else None
+  except FileNotFoundError:
+    return None
+
+
+def set_local_manifest(path, manifest):
+  '''record that `path` matches `manifest`, None if it may have diverged'''
+  if manifest is None:
+    if os.path.exists(manifest_path(path)):
+      os.remove(manifest_path(path))
+  else:
+    with open(manifest_path(path), 'w') as f:
+      json.dump(manifest, f)
+
+
+def pull_replica(store, path):
+  '''bring the db at `path` up to date with the replica in `store`, only
+  downloading the segments it doesn't have when it can. returns the manifest,
+  None if there is no replica yet'''
+  local = get_local_manifest(path)
+  with tempfile.TemporaryDirectory() as tmp:
+    try:
+      store.download(MANIFEST, os.path.join(tmp, MANIFEST))
+    except FileNotFoundError:
+      return None
+    with open(os.path.join(tmp, MANIFEST)) as f:
+      remote = json.load(f)
+
+    if local == remote:
+      l.info(f'Replica is current at {remote["base"]} + {len(remote["segments"])} segments')
+      return remote
+    n = len(local['segments']) if local else 0
+    if local and local['base'] == remote['base'] and local['segments'] == remote['segments'][:n]:
+      segments = remote['segments'][n:]
+    else:
+      l.info(f'Restoring {remote["base"]}...')
+      store.download(remote['base'], path)
+      discard_wal(path)
+      segments = remote['segments']
+
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    for s in segments:
+      l.info(f'Applying {s}...')
+      store.download(s, os.path.join(tmp, s))
+      apply_segment(conn, c, os.path.join(tmp, s))
+      os.remove(os.path.join(tmp, s))
+    # replayed rows are in the replica already
+    c.execute('''DELETE FROM changelog''')
+    conn.commit()
+    conn.close()
+
+  set_local_manifest(path, remote)
+  return remote
+
+
+def push_replica(store, path, manifest):
+  '''ship rows changed in the db at `path` since it matched `manifest` as a
+  new segment, or the whole db as a new base once there are
+  COMPACT_SEGMENTS segments, the schema changed or the db was vacuumed.
+  returns the new manifest'''
+  conn = sqlite3.connect(path)
+  c = conn.cursor()
+  enable_changelog(c)
+  conn.commit()
+  version = c.execute('''PRAGMA user_version''').fetchone()[0]
+  seq = c.execute('''SELECT max(seq) FROM changelog''').fetchone()[0]
+
+  rebase = get_state(c, 'rebase_replica')
+  compact = (not manifest or manifest['version'] != version
+      or len(manifest['segments']) >= COMPACT_SEGMENTS or rebase)
+  if not compact and seq is None:
+    conn.close()
+    set_local_manifest(path, manifest)
+    return manifest
+
+  n = manifest['next'] if manifest else 0
+  with tempfile.TemporaryDirectory() as tmp:
+    if compact:
+      if rebase:
+        c.execute('''DELETE FROM state WHERE key = ?''', ('rebase_replica',))
+        conn.commit()
+      name = f'base-{n:08d}.db'
+      c.execute('''VACUUM INTO ?''', (os.path.join(tmp, name),))
+      new = {'version': version, 'base': name, 'segments': [], 'next': n + 1}
+    else:
+      name = f'segment-{n:08d}.db'
+      export_segment(conn, c, os.path.join(tmp, name), seq)
+      new = dict(manifest, segments=manifest['segments'] + [name], next=n + 1)
+    l.info(f'Uploading {name} ({os.path.getsize(os.path.join(tmp, name))} bytes)...')
+    store.upload(os.path.join(tmp, name), name)
+
+    # the manifest is written last, so a failed push leaves the replica as is
+    with open(os.path.join(tmp, MANIFEST), 'w') as f:
+      json.dump(new, f)
+    store.upload(os.path.join(tmp, MANIFEST), MANIFEST)
+
+  if seq is not None:
+    c.execute('''DELETE FROM changelog WHERE seq <= ?''', (seq,))
+    conn.commit()
+  conn.close()
+  set_local_manifest(path, new)
+
+  if compact and manifest:
+    for old in [manifest['base']] + manifest['segments']:
+      store.delete(old)
+  return new
+
+
+def restore_replica(args):
+  '''restore the db from the replica in the store, on top of the last restore
+  unless forced'''
+  if args.force:
+    set_local_manifest(DBNAME, None)
+  if not args.dry_run and pull_replica(get_store(), DBNAME) is None:
+    l.error('No replica to restore from')
@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 import os
+import re
+import zlib
 import hashlib
 import json
 import sqlite3
 import logging as l
 from enum import Enum
 from dataclasses import dataclass
+from dbwriter import connect
+
+# zstd compresses pages better and faster, but is optional
+try:
+  import zstandard
+  BODY_CODEC = 'zstd'
+except ImportError:
+  BODY_CODEC = 'zlib'
 
 DBNAME = (
     'data/dumps.db' if 'GCS_BUCKET_NAME' not in os.environ else
@@ -29,8 +39,102 @@ CREATE TABLE IF NOT EXISTS notifications (
   action TEXT NOT NULL,
   data JSON NOT NULL DEFAULT '{}'
 );
+
+CREATE TABLE IF NOT EXISTS bodies (
+  hash TEXT PRIMARY KEY,
+  codec TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  data BLOB NOT NULL
+);
 '''
 
+# schema changes applied in order, `PRAGMA user_version` counts those applied
+MIGRATIONS = [
+    # 1: base tables
+    SCHEMA_UP_SQL,
+    # 2: page validators, fingerprint, extractor version and archived body
+    lambda c: _add_columns(c, 'dumps', [
+      ('etag', 'TEXT'),
+      ('last_modified', 'TEXT'),
+      ('fingerprint', 'TEXT'),
+      ('last_seen', 'INTEGER'),
+      ('extractor_version', 'INTEGER'),
+      ('body_hash', 'TEXT REFERENCES bodies(hash)'),
+      ]),
+    # 3: indexes for the hot queries
+    '''
+    CREATE INDEX IF NOT EXISTS dumps_url_status_timestamp
+      ON dumps (url, status, timestamp);
+    CREATE INDEX IF NOT EXISTS notifications_name_unit_last_notified
+      ON notifications (name, unit, last_notified);
+    ''',
+    # 4: typed unit observations, filled from the extracted data of each dump
+    lambda c: _create_observations(c),
+    # 5: per day price aggregate kept up to date by history runs
+    '''
+    CREATE TABLE daily_prices (
+      url TEXT NOT NULL,
+      model TEXT NOT NULL,
+      unit TEXT NOT NULL,
+      day TEXT NOT NULL,
+      price INTEGER NOT NULL,
+      -- when the dump the price came from was pulled, the latest wins the day
+      timestamp INTEGER NOT NULL,
+      -- last time that day the price was seen
+      seen INTEGER NOT NULL,
+      PRIMARY KEY (url, model, unit, day)
+    );
+    CREATE TABLE state (
+      key TEXT PRIMARY KEY,
+      value
+    );
+    CREATE INDEX dumps_seen ON dumps (coalesce(last_seen, timestamp));
+    ''',
+    # 6: notifications waiting to be emailed to each recipient
+    '''
+    CREATE TABLE outbox (
+      id INTEGER PRIMARY KEY,
+      notification_id INTEGER NOT NULL REFERENCES notifications(id),
+      recipient TEXT NOT NULL,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt INTEGER NOT NULL DEFAULT 0,
+      -- when it was sent, NULL while pending
+      sent INTEGER,
+      error TEXT
+    );
+    CREATE INDEX outbox_pending ON outbox (next_attempt) WHERE sent IS NULL;
+    ''',
+    ]
+
+# latest successful dump for each url in the json array parameter
+LATEST_DUMPS_SQL = '''
+SELECT d.*
+FROM json_each(?) u
+JOIN dumps d ON d.id = (
+  SELECT id
+  FROM dumps
+  WHERE url = u.value AND status = 200
+  ORDER BY timestamp DESC
+  LIMIT 1
+)
+'''
+
+# observed units of dumps pulled or seen again after a time, oldest first
+CHANGED_OBSERVATIONS_SQL = '''
+SELECT o.url, o.model, o.unit, o.timestamp, d.last_seen, o.price
+FROM dumps d
+JOIN observations o ON o.dump_id = d.id
+WHERE coalesce(d.last_seen, d.timestamp) > ?
+ORDER BY o.timestamp, o.id
+'''
+
+# queries made on every run, which must stay indexed
+HOT_QUERIES = {
+    'latest dumps': (LATEST_DUMPS_SQL, ('["url"]',)),
+    'changed observations': (CHANGED_OBSERVATIONS_SQL, (0,)),
+    }
+
+
 @dataclass
 class Dump:
   id: int
@@ -39,10 +143,37 @@ class Dump:
   status: int
   body: str
   extracted: str
+  # validators and fingerprint of the page, used to skip unchanged pulls
+  etag: str = None
+  last_modified: str = None
+  fingerprint: str = None
+  # last time the page was pulled and found unchanged
+  last_seen: int = None
+  # version of the extractor that produced `extracted`
+  extractor_version: int = None
+  # raw page, stored compressed in `bodies` once per distinct page
+  body_hash: str = None
 
-  def insert(self, conn, c):
+  def insert(self, conn, c, commit=True):
     return _insert(conn, c, self, 'dumps',
-        ('url', 'timestamp', 'status', 'body', 'extracted'))
+        ('url', 'timestamp', 'status', 'body', 'extracted',
+          'etag', 'last_modified', 'fingerprint', 'last_seen',
+          'extractor_version', 'body_hash'), commit)
+
+  def insert_with_observations(self, conn, c, data, commit=True):
+    '''insert dump along with the units extracted from it'''
+    self.insert(conn, c, commit=False)
+    insert_observations(c, self.id, self.url, self.timestamp, self.status, data)
+    if commit:
+      conn.commit()
+
+  def touch(self, conn, c):
+    '''record that the dump was still current at `last_seen`'''
+    c.execute('''
+        UPDATE dumps SET last_seen = ?, etag = ?, last_modified = ?
+        WHERE id = ?
+        ''', (self.last_seen, self.etag, self.last_modified, self.id))
+    conn.commit()
 
 
 class NotificationAction(Enum):
@@ -61,12 +192,115 @@ class Notification:
   action: str
   data: int
 
-  def insert(self, conn, c):
-    return _insert(conn, c, self, 'notifications',
-        ('name', 'unit', 'last_notified', 'action', 'data'))
+  FIELDS = ('name', 'unit', 'last_notified', 'action', 'data')
+
+  def insert(self, conn, c, commit=True):
+    return _insert(conn, c, self, 'notifications', self.FIELDS, commit)
+
+  @classmethod
+  def insert_many(cls, conn, c, notifications, commit=True):
+    return _insert_many(conn, c, notifications, 'notifications', cls.FIELDS, commit)
+
+
+def store_body(c, body):
+  '''compress and save page `body` if not already stored, return its hash'''
+  h = hashlib.sha256(body.encode()).hexdigest()
+  if not c.execute('''SELECT 1 FROM bodies WHERE hash = ?''', (h,)).fetchone():
+    c.execute('''INSERT INTO bodies (hash, codec, size, data) VALUES (?, ?, ?, ?)''',
+        (h, BODY_CODEC, len(body), compress_body(body)))
+  return h
+
+
+def compress_body(body, codec=BODY_CODEC):
+  if codec == 'zstd':
+    return zstandard.ZstdCompressor(level=10).compress(body.encode())
+  return zlib.compress(body.encode(), 9)
+
+
+def decompress_body(data, codec):
+  if codec == 'zstd':
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data).decode()
+  return zlib.decompress(data).decode()
+
+
+def insert_observations(c, dump_id, url, timestamp, status, data):
+  '''save units extracted from a successful dump as observations'''
+  if status != 200 or not data:
+    return
+  c.executemany('''
+      INSERT INTO observations
+        (dump_id, url, model, unit, timestamp, price, sqft, available)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+      ''', [
+        (dump_id, url, u['model'], u['unit'], timestamp,
+          u['price'], u['sqft'], u['available'])
+        for u in data])
+
+
+def _create_observations(c):
+  c.execute('''
+      CREATE TABLE observations (
+        id INTEGER PRIMARY KEY,
+        dump_id INTEGER NOT NULL REFERENCES dumps(id),
+        url TEXT NOT NULL,
+        model TEXT NOT NULL,
+        unit TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        price INTEGER NOT NULL,
+        sqft INTEGER NOT NULL,
+        available TEXT NOT NULL
+      )''')
+  c.execute('''CREATE INDEX observations_url_timestamp ON observations (url, timestamp)''')
+  c.execute('''CREATE INDEX observations_dump_id ON observations (dump_id)''')
+  fill_observations(c)
+
+
+def fill_observations(c):
+  '''(re)build observations from the extracted data of all dumps'''
+  c.execute('''DELETE FROM observations''')
+  n, last_id = 0, -1
+  while True:
+    rows = c.execute('''
+        SELECT id, url, timestamp, status, extracted FROM dumps
+        WHERE id > ? AND status = 200
+        ORDER BY id
+        LIMIT 1024
+        ''', (last_id,)).fetchall()
+    if not rows:
+      break
+    last_id = rows[-1][0]
+    for id, url, timestamp, status, extracted in rows:
+      insert_observations(c, id, url, timestamp, status,
+          json.loads(extracted or 'null'))
+    n += len(rows)
+  l.info(f'Filled observations from {n} dumps')
 
 
-def _insert(conn, c, dc, table_name, fields):
+def backfill_observations(args):
+  conn, c = get_db()
+  fill_observations(c)
+  reset_price_history(c)
+  conn.commit()
+
+
+def get_state(c, key, default=None):
+  r = c.execute('''SELECT value FROM state WHERE key = ?''', (key,)).fetchone()
+  return r[0] if r else default
+
+
+def set_state(c, key, value):
+  c.execute('''INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)''',
+      (key, value))
+
+
+def reset_price_history(c):
+  '''drop the daily price aggregate, so the next history run rebuilds it'''
+  c.execute('''DELETE FROM daily_prices''')
+  c.execute('''DELETE FROM state WHERE key = ?''', ('history_watermark',))
+
+
+def _insert(conn, c, dc, table_name, fields, commit=True):
   '''insert dataclass into database'''
   vals = tuple([dc.__dict__[f] for f in fields])
   c.execute(f'''
@@ -74,23 +308,109 @@ def _insert(conn, c, dc, table_name, fields):
       VALUES ({','.join(['?']*len(fields))})
       ''', vals)
   dc.id = c.lastrowid
-  conn.commit()
+  if commit:
+    conn.commit()
 
 
-def get_db(migrate=False):
-  '''get cursor to db, setup schema if not present'''
-  exists = os.path.exists(DBNAME)
-  conn = sqlite3.connect(DBNAME)
+def _insert_many(conn, c, dcs, table_name, fields, commit=True):
+  '''insert dataclasses into database with one executemany. they are given
+  the ids after the current max, so the caller can refer to them'''
+  first = c.execute(f'''SELECT coalesce(max(id), 0) + 1 FROM {table_name}''').fetchone()[0]
+  for i, dc in enumerate(dcs):
+    dc.id = first + i
+  c.executemany(f'''
+      INSERT INTO {table_name} (id, {','.join(fields)})
+      VALUES ({','.join(['?']*(len(fields) + 1))})
+      ''', [tuple([dc.id] + [dc.__dict__[f] for f in fields]) for dc in dcs])
+  if commit:
+    conn.commit()
+
+
+def get_db():
+  '''get cursor to db, migrating schema to the latest version'''
+  conn = connect(DBNAME)
   c = conn.cursor()
-  if not exists or migrate:
-    l.info('Database not found/outdated. Setting up schema...')
-    c.executescript(SCHEMA_UP_SQL)
+  migrate(conn, c)
   return conn, c
 
 
-def get_db_hash():
-  h = hashlib.md5()
-  with open(DBNAME, 'rb') as f:
-    for chunk in iter(lambda: f.read(128 * h.block_size), b''):
-      h.update(chunk)
-  return h.hexdigest()
+class ChangeTracker:
+  '''notices commits to the db made through any other connection since it
+  was created, without reading the db file'''
+  def __init__(self):
+    self.conn = sqlite3.connect(DBNAME)
+    self.version = self.data_version()
+
+  def data_version(self):
+    # changes whenever another connection commits, including schema changes
+    return self.conn.execute('''PRAGMA data_version''').fetchone()[0]
+
+  def changed(self):
+    return self.data_version() != self.version
+
+  def close(self):
+    self.conn.close()
+
+
+def migrate(conn, c):
+  '''apply migrations not yet applied to the db, each in a transaction'''
+  version = c.execute('''PRAGMA user_version''').fetchone()[0]
+  for n, m in enumerate(MIGRATIONS[version:], version + 1):
+    l.info(f'Migrating database to version {n}...')
+    if callable(m):
+      c.execute('''BEGIN''')
+      m(c)
+      c.execute(f'''PRAGMA user_version = {n}''')
+      conn.commit()
+    else:
+      c.executescript(f'''BEGIN; {m}; PRAGMA user_version = {n}; COMMIT;''')
+
+
+def _add_columns(c, table, columns):
+  '''add `columns` the table doesn't have yet'''
+  existing = {r[1] for r in c.execute(f'''PRAGMA table_info({table})''')}
+  for column, sql_type in columns:
+    if column not in existing:
+      c.execute(f'''ALTER TABLE {table} ADD COLUMN {column} {sql_type}''')
+
+
+class QueryPlanError(Exception):
+  pass
+
+
+def check_query_plans(args):
+  '''fail if any of the hot queries would scan a table instead of using an
+  index'''
+  conn, c = get_db()
+  scans = []
+  for name, (sql, params) in HOT_QUERIES.items():
+    for r in c.execute(f'''EXPLAIN QUERY PLAN {sql}''', params):
+      detail = r[-1]
+      l.info(f'{name}: {detail}')
+      if re.match(r'SCAN \w', detail) and 'INDEX' not in detail:
+        scans.append(f'{name}: {detail}')
+  if scans:
+    raise QueryPlanError('Queries scan tables:\n' + '\n'.join(scans))
+
+
+def archive_bodies(args):
+  '''move page bodies still stored inline in `dumps` into `bodies`'''
+  conn, c = get_db()
+  n, last_id = 0, -1
+  while True:
+    rows = c.execute('''
+        SELECT id, body FROM dumps
+        WHERE id > ? AND body != ''
+        ORDER BY id
+        LIMIT 256
+        ''', (last_id,)).fetchall()
+    if not rows:
+      break
+    last_id = rows[-1][0]
+
+    if not args.dry_run:
+      c.executemany('''UPDATE dumps SET body = '', body_hash = ? WHERE id = ?''',
+          [(store_body(c, body), id) for id, body in rows])
+      conn.commit()
+    n += len(rows)
+  l.info(f'Archived {n} page bodies')
@@ -2,7 +2,6 @@
 import os
 import json
 import logging as l
-from sheetfu import SpreadsheetApp, Table
 from schema import Dump, Notification, NotificationAction, get_db
 
 
@@ -25,6 +24,7 @@ PULL_INTERVAL = 3600
 
 
 def get_google_sheet():
+  from sheetfu import SpreadsheetApp
   sa = SpreadsheetApp(TOKEN_PATH)
   return sa.open_by_id(SHEET_NAME)
 
@@ -37,6 +37,7 @@ def get_apartments_from_google_sheets(local=False):
       return json.loads(f.read())
   else:
     l.info('Getting data from spreadsheet...')
+    from sheetfu import Table
     sp = get_google_sheet()
     s = sp.sheets[0]
     table = Table(s.get_data_range())
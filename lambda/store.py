@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import logging as l
+import metrics
+from dbwriter import discard_wal
+
+
+class Store:
+  '''a bucket of named blobs, every write to a blob gives it a new generation'''
+  def download(self, name, path, generation=None):
+    '''copy blob `name` to `path` unless it is still at `generation`.
+    returns the generation now at `path`, FileNotFoundError if missing'''
+    raise NotImplementedError
+
+  def upload(self, path, name):
+    '''copy `path` to blob `name`, returns its new generation'''
+    raise NotImplementedError
+
+  def delete(self, name):
+    '''remove blob `name` if it exists'''
+    raise NotImplementedError
+
+
+class GCSStore(Store):
+  '''blobs in a google cloud storage bucket'''
+  def __init__(self, bucket_name):
+    from google.cloud import storage
+    # unlike get_bucket, this doesn't make a request
+    self.bucket = storage.Client().bucket(bucket_name)
+
+  def download(self, name, path, generation=None):
+    from google.api_core.exceptions import NotModified, NotFound
+    blob = self.bucket.blob(name)
+    # a failed or skipped download would truncate `path`
+    tmp = path + '.part'
+    try:
+      blob.download_to_filename(tmp, if_generation_not_match=generation)
+      os.replace(tmp, path)
+      metrics.count('store_download_bytes', os.path.getsize(path))
+    except NotModified:
+      return generation
+    except NotFound:
+      raise FileNotFoundError(name)
+    finally:
+      if os.path.exists(tmp):
+        os.remove(tmp)
+    return str(blob.generation)
+
+  def upload(self, path, name):
+    blob = self.bucket.blob(name)
+    blob.upload_from_filename(path)
+    metrics.count('store_upload_bytes', os.path.getsize(path))
+    return str(blob.generation)
+
+  def delete(self, name):
+    from google.api_core.exceptions import NotFound
+    try:
+      self.bucket.delete_blob(name)
+    except NotFound:
+      pass
+
+
+class LocalStore(Store):
+  '''blobs as files in directory `root`, to run on_event without a bucket'''
+  def __init__(self, root):
+    self.root = root
+
+  def generation(self, name):
+    # uploads replace the file, so its inode changes even when writes are
+    # closer together than the mtime resolution of the filesystem
+    s = os.stat(os.path.join(self.root, name))
+    return f'{s.st_ino}-{s.st_mtime_ns}'
+
+  def download(self, name, path, generation=None):
+    current = self.generation(name)
+    if current == generation:
+      return generation
+    tmp = path + '.part'
+    shutil.copyfile(os.path.join(self.root, name), tmp)
+    os.replace(tmp, path)
+    metrics.count('store_download_bytes', os.path.getsize(path))
+    return current
+
+  def upload(self, path, name):
+    tmp = os.path.join(self.root, name + '.part')
+    shutil.copyfile(path, tmp)
+    os.replace(tmp, os.path.join(self.root, name))
+    metrics.count('store_upload_bytes', os.path.getsize(path))
+    return self.generation(name)
+
+  def delete(self, name):
+    if os.path.exists(os.path.join(self.root, name)):
+      os.remove(os.path.join(self.root, name))
+
+
+def get_store():
+  '''local directory `STORE_DIR` if set, otherwise the GCS bucket'''
+  if 'STORE_DIR' in os.environ:
+    return LocalStore(os.environ['STORE_DIR'])
+  return GCSStore(os.environ['GCS_BUCKET_NAME'])
+
+
+def generation_path(path):
+  return path + '.generation'
+
+
+def get_cached_generation(path):
+  '''generation of the blob last copied to `path`, None if unknown'''
+  try:
+    with open(generation_path(path)) as f:
+      return f.read().strip() if os.path.exists(path) else None
+  except FileNotFoundError:
+    return None
+
+
+def set_cached_generation(path, generation):
+  '''record that `path` holds `generation`, None if it may have diverged'''
+  if generation is None:
+    if os.path.exists(generation_path(path)):
+      os.remove(generation_path(path))
+  else:
+    with open(generation_path(path), 'w') as f:
+      f.write(generation)
+
+
+def download_cached(store, name, path):
+  '''copy blob `name` to `path`, skipped when a warm instance already has
+  its current generation there. returns that generation'''
+  cached = get_cached_generation(path)
+  generation = store.download(name, path, cached)
+  if generation == cached:
+    l.info(f'{name} is current at generation {generation}')
+  else:
+    l.info(f'Downloaded {name} at generation {generation}')
+    # left from the copy it replaced, it would corrupt the new one
+    discard_wal(path)
+    set_cached_generation(path, generation)
+  return generation
+
+
+def upload_cached(store, path, name):
+  '''copy `path` to blob `name`, recording the generation it now holds'''
+  generation = store.upload(path, name)
+  set_cached_generation(path, generation)
+  l.info(f'Uploaded {name} at generation {generation}')
+  return generation
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+'''the app's modules import each other by name from lambda/'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# read from secrets/ on import otherwise
+os.environ.setdefault('SHEET_NAME', 'test')
+os.environ.setdefault('EMAIL_SENDER', 'sender@example.com')
+os.environ.setdefault('EMAIL_RECIPIENTS', 'a@example.com')
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import random
+import argparse
+import sqlite3
+import pytest
+
+import history
+from schema import migrate, get_state
+
+
+class FakeRange:
+  def __init__(self, sheet, row, column, number_of_row, number_of_column):
+    self.sheet = sheet
+    self.cells = [(row + i, column + j)
+        for i in range(number_of_row) for j in range(number_of_column)]
+    self.number_of_column = number_of_column
+
+  def set_value(self, value):
+    for k in self.cells:
+      self.sheet.write(k, value)
+
+  def set_values(self, values, batch_to=None):
+    assert len(values) * self.number_of_column == len(self.cells)
+    assert all(len(r) == self.number_of_column for r in values)
+    writes = [(k, v) for k, v in zip(self.cells, (v for r in values for v in r))]
+    if batch_to:
+      batch_to.pending.append((self.sheet, writes))
+    else:
+      for k, v in writes:
+        self.sheet.write(k, v)
+    self.sheet.ranges_written.append(len(writes))
+
+
+class FakeSheet:
+  '''cells keyed by 1 based (row, column), like sheetfu's ranges'''
+  def __init__(self):
+    self.cells = {}
+    self.ranges_written = []
+
+  def write(self, k, v):
+    if v is None:
+      self.cells.pop(k, None)
+    else:
+      self.cells[k] = v
+
+  def get_range(self, row, column, number_of_row=1, number_of_column=1):
+    return FakeRange(self, row, column, number_of_row, number_of_column)
+
+  def get_data_range(self):
+    rows = max((r for r, _ in self.cells), default=1)
+    columns = max((c for _, c in self.cells), default=1)
+    return FakeRange(self, 1, 1, rows, columns)
+
+
+class FakeSpreadsheet:
+  def __init__(self):
+    self.sheets = [FakeSheet(), FakeSheet()]
+    self.pending = []
+    self.commits = 0
+
+  def commit(self):
+    for sheet, writes in self.pending:
+      for k, v in writes:
+        sheet.write(k, v)
+    self.pending = []
+    self.commits += 1
+
+
+def cells(grid):
+  return {(i + 1, j + 1): v for i, r in enumerate(grid)
+      for j, v in enumerate(r) if v is not None}
+
+
+def grid(units, days, price=1500):
+  return ([[None] + [f'Jan {d + 1} 2024' for d in range(days)]]
+      + [[f'Apartment - A/{u}'] + [price + u + d for d in range(days)]
+        for u in range(units)])
+
+
+@pytest.fixture
+def app(monkeypatch):
+  '''sync_price_history against an in memory db and a fake spreadsheet,
+  syncing whatever grid is in `app.vals`'''
+  conn = sqlite3.connect(':memory:')
+  c = conn.cursor()
+  migrate(conn, c)
+  sp = FakeSpreadsheet()
+  app = argparse.Namespace(c=c, sp=sp, sheet=sp.sheets[1], vals=None)
+  monkeypatch.setattr(history, 'get_db', lambda: (conn, c))
+  monkeypatch.setattr(history, 'get_price_history', lambda conn, c: app.vals)
+  monkeypatch.setattr(history, 'get_google_sheet', lambda: sp)
+
+  def sync(vals, force=False):
+    app.vals = vals
+    app.sheet.ranges_written = []
+    history.sync_price_history(argparse.Namespace(dry_run=False, force=force))
+  app.sync = sync
+  return app
+
+
+def test_missing_snapshot_writes_whole_grid(app):
+  app.sheet.cells = {(40, 40): 'stale'}
+  app.sync(grid(3, 5))
+  assert app.sheet.cells == cells(grid(3, 5))
+  assert app.sheet.ranges_written == [4 * 6]
+  assert app.sp.commits == 1
+  assert get_state(app.c, 'sheet_snapshot') is not None
+
+
+def test_force_rewrites_whole_grid(app):
+  app.sync(grid(3, 5))
+  # edited by hand since, which only a forced sync overwrites
+  app.sheet.cells[(2, 2)] = 'edited'
+  app.sync(grid(3, 5))
+  assert app.sheet.cells[(2, 2)] == 'edited'
+  app.sync(grid(3, 5), force=True)
+  assert app.sheet.cells == cells(grid(3, 5))
+  assert app.sheet.ranges_written == [4 * 6]
+
+
+def test_only_changed_cells_are_pushed(app):
+  app.sync(grid(3, 5))
+  vals = grid(3, 5)
+  vals[2][3] = 9999
+  app.sync(vals)
+  assert app.sheet.cells == cells(vals)
+  assert app.sheet.ranges_written == [1]
+
+
+def test_unchanged_grid_pushes_nothing(app):
+  app.sync(grid(3, 5))
+  snapshot = get_state(app.c, 'sheet_snapshot')
+  app.sync(grid(3, 5))
+  assert app.sheet.ranges_written == []
+  assert get_state(app.c, 'sheet_snapshot') == snapshot
+
+
+@pytest.mark.parametrize('old, new', [
+    ((3, 5), (3, 6)),  # a new day
+    ((3, 5), (5, 5)),  # new units
+    ((3, 5), (5, 8)),
+    ((5, 8), (3, 5)),  # units and days gone
+    ((3, 5), (2, 5)),
+    ((3, 5), (3, 4)),
+    ])
+def test_grid_grows_and_shrinks(app, old, new):
+  app.sync(grid(*old))
+  app.sync(grid(*new, price=1600))
+  assert app.sheet.cells == cells(grid(*new, price=1600))
+  assert get_state(app.c, 'sheet_snapshot') is not None
+
+
+def test_ranges_turn_old_grid_into_new():
+  rng = random.Random(0)
+  random_grid = lambda: [[rng.choice((None, 1, 2)) for _ in range(rng.randint(0, 6))]
+      for _ in range(rng.randint(0, 6))]
+  for _ in range(500):
+    old, new = random_grid(), random_grid()
+    sheet = cells(old)
+    for row, column, block in history.diff_sheet_ranges(old, new):
+      for i, r in enumerate(block):
+        for j, v in enumerate(r):
+          sheet.pop((row + i + 1, column + j + 1), None)
+          if v is not None:
+            sheet[(row + i + 1, column + j + 1)] = v
+    assert sheet == cells(new)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import json
+import smtplib
+import sqlite3
+import pytest
+
+import notify
+from notify import (queue_notifications, dispatch_notifications, connect_smtp,
+    RETRY_BACKOFF, MAX_ATTEMPTS)
+from schema import migrate, Notification
+
+
+class FakeSMTP:
+  '''smtplib.SMTP refusing the recipients in `refused`, and dropping the
+  connection when sending to the ones in `disconnects`'''
+  refused = set()
+  disconnects = set()
+  login_error = None
+
+  def __init__(self, host, port, timeout=None):
+    self.server.connections.append(self)
+    self.closed = False
+
+  def ehlo(self):
+    pass
+
+  def starttls(self):
+    pass
+
+  def has_extn(self, name):
+    return name == 'auth'
+
+  def login(self, user, password):
+    if self.login_error:
+      raise self.login_error
+
+  def send_message(self, msg):
+    assert not self.closed
+    to = msg['To']
+    if to in self.disconnects:
+      raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+    if to in self.refused:
+      raise smtplib.SMTPRecipientsRefused({to: (550, b'No such user')})
+    self.server.sent.append((to, msg['Subject']))
+
+  def close(self):
+    self.closed = True
+
+  def quit(self):
+    self.closed = True
+
+
+class Clock:
+  def __init__(self, t):
+    self.t = t
+
+  def time(self):
+    return self.t
+
+
+@pytest.fixture
+def server(monkeypatch):
+  class Server(FakeSMTP):
+    pass
+  Server.server = Server
+  Server.connections, Server.sent = [], []
+  Server.refused, Server.disconnects = set(), set()
+  monkeypatch.setattr(notify.smtplib, 'SMTP', Server)
+  return Server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = Clock(1700000000.0)
+  monkeypatch.setattr(notify, 'time', clock)
+  return clock
+
+
+@pytest.fixture
+def db():
+  conn = sqlite3.connect(':memory:')
+  c = conn.cursor()
+  migrate(conn, c)
+  return conn, c
+
+
+def queue(db, recipients, n=2):
+  conn, c = db
+  notifications = [Notification(0, 'Apartment', f'A/{i}', 1700000000, 'ADDED',
+    json.dumps({'price': 1500 + i, 'sqft': 700, 'available': 'Now'})) for i in range(n)]
+  queue_notifications(c, recipients, notifications)
+  conn.commit()
+  return notifications
+
+
+def outbox(db, recipient):
+  return db[1].execute('''
+      SELECT sent IS NOT NULL, attempts, next_attempt, error
+      FROM outbox WHERE recipient = ? ORDER BY id
+      ''', (recipient,)).fetchall()
+
+
+def test_refused_recipient_doesnt_stop_the_others(db, server, clock):
+  queue(db, ['a@example.com', 'b@example.com', 'c@example.com'])
+  server.refused = {'b@example.com'}
+  dispatch_notifications(*db)
+
+  assert [to for to, _ in server.sent] == ['a@example.com', 'c@example.com']
+  # refusing a recipient leaves the connection usable
+  assert len(server.connections) == 1
+  assert outbox(db, 'a@example.com') == [(1, 0, 0, None)] * 2
+  assert outbox(db, 'c@example.com') == [(1, 0, 0, None)] * 2
+  for sent, attempts, next_attempt, error in outbox(db, 'b@example.com'):
+    assert (sent, attempts, next_attempt) == (0, 1, clock.t + RETRY_BACKOFF)
+    assert 'No such user' in error
+
+
+def test_disconnect_reconnects_for_the_next_recipient(db, server, clock):
+  queue(db, ['a@example.com', 'b@example.com'])
+  server.disconnects = {'a@example.com'}
+  dispatch_notifications(*db)
+  assert [to for to, _ in server.sent] == ['b@example.com']
+  assert len(server.connections) == 2
+  assert server.connections[0].closed
+  assert outbox(db, 'a@example.com')[0][:2] == (0, 1)
+
+
+def test_retries_back_off(db, server, clock):
+  queue(db, ['a@example.com'], n=1)
+  server.refused = {'a@example.com'}
+  dispatch_notifications(*db)
+  due = clock.t + RETRY_BACKOFF
+  assert outbox(db, 'a@example.com')[0][1:3] == (1, due)
+  for attempts in range(1, 3):
+    # not retried before it is due
+    clock.t = due - 1
+    dispatch_notifications(*db)
+    assert outbox(db, 'a@example.com')[0][1] == attempts
+    clock.t = due
+    dispatch_notifications(*db)
+    due += RETRY_BACKOFF * 2 ** attempts
+    assert outbox(db, 'a@example.com')[0][1:3] == (attempts + 1, due)
+
+  server.refused = set()
+  clock.t = due
+  dispatch_notifications(*db)
+  assert server.sent == [('a@example.com', '1 New Apartment Updates!')]
+  assert outbox(db, 'a@example.com') == [(1, 3, due, None)]
+
+
+def test_second_dispatch_sends_nothing_twice(db, server, clock):
+  queue(db, ['a@example.com', 'b@example.com'])
+  dispatch_notifications(*db)
+  assert len(server.sent) == 2
+  dispatch_notifications(*db)
+  assert len(server.sent) == 2
+  assert len(server.connections) == 1
+
+  # only what was queued since
+  queue(db, ['b@example.com'], n=1)
+  dispatch_notifications(*db)
+  assert server.sent[2:] == [('b@example.com', '1 New Apartment Updates!')]
+
+
+def test_gives_up_after_max_attempts(db, server, clock, caplog):
+  queue(db, ['a@example.com'], n=1)
+  server.refused = {'a@example.com'}
+  for _ in range(MAX_ATTEMPTS + 2):
+    dispatch_notifications(*db)
+    clock.t += RETRY_BACKOFF * 2 ** MAX_ATTEMPTS
+  assert outbox(db, 'a@example.com')[0][:2] == (0, MAX_ATTEMPTS)
+  assert len([r for r in caplog.records if r.levelname == 'WARNING'
+    and 'Giving up' in r.message]) == 1
+
+
+def test_connect_closes_connection_when_login_fails(server):
+  server.login_error = smtplib.SMTPAuthenticationError(535, b'Bad credentials')
+  with pytest.raises(smtplib.SMTPAuthenticationError):
+    connect_smtp()
+  assert server.connections[0].closed
+
+
+def test_queue_links_outbox_to_notifications(db):
+  queue(db, ['a@example.com'], n=1)
+  notifications = queue(db, ['a@example.com', 'b@example.com'], n=3)
+  assert [n.id for n in notifications] == [2, 3, 4]
+  assert db[1].execute('''
+      SELECT o.recipient, n.unit FROM outbox o
+      JOIN notifications n ON n.id = o.notification_id
+      WHERE n.id > 1 ORDER BY o.id
+      ''').fetchall() == [(r, f'A/{i}') for i in range(3)
+        for r in ('a@example.com', 'b@example.com')]
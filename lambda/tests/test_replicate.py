@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import sqlite3
+import pytest
+
+import replicate
+from replicate import (push_replica, pull_replica, restore_replica,
+    get_local_manifest, set_local_manifest, get_tables, MANIFEST)
+from schema import migrate, get_state, set_state
+from store import LocalStore
+
+
+class CountingStore(LocalStore):
+  '''LocalStore that remembers the blobs downloaded from it'''
+  def __init__(self, root):
+    super().__init__(root)
+    self.downloaded = []
+
+  def download(self, name, path, generation=None):
+    self.downloaded.append(name)
+    return super().download(name, path, generation)
+
+
+@pytest.fixture
+def store(tmp_path):
+  os.mkdir(tmp_path / 'store')
+  return CountingStore(str(tmp_path / 'store'))
+
+
+@pytest.fixture
+def source(tmp_path):
+  path = str(tmp_path / 'source.db')
+  conn = sqlite3.connect(path)
+  migrate(conn, conn.cursor())
+  conn.close()
+  return path
+
+
+def write(path, *sql):
+  conn = sqlite3.connect(path)
+  for s in sql:
+    conn.execute(s)
+  conn.commit()
+  conn.close()
+
+
+def add_dumps(path, first, n):
+  write(path, *(f'''
+      INSERT INTO dumps (id, url, timestamp, status, body)
+      VALUES ({i}, 'https://example.com/{i % 3}', {1700000000 + i}, 200, 'body {i}')
+      ''' for i in range(first, first + n)))
+
+
+def contents(path):
+  '''rows of every replicated table, by rowid'''
+  conn = sqlite3.connect(path)
+  c = conn.cursor()
+  rows = {t: c.execute(f'''SELECT rowid, * FROM "{t}" ORDER BY rowid''').fetchall()
+      for t in get_tables(c)}
+  conn.close()
+  return rows
+
+
+def blobs(store):
+  return sorted(os.listdir(store.root))
+
+
+def test_push_ships_segments_that_pull_applies(tmp_path, store, source):
+  replica = str(tmp_path / 'replica.db')
+  add_dumps(source, 1, 10)
+  manifest = push_replica(store, source, None)
+  assert manifest['base'] and manifest['segments'] == []
+  assert pull_replica(store, replica) == manifest
+  assert contents(replica) == contents(source)
+
+  # inserts, updates and deletes since
+  add_dumps(source, 11, 5)
+  write(source,
+      '''UPDATE dumps SET status = 404 WHERE id IN (2, 12)''',
+      '''DELETE FROM dumps WHERE id IN (3, 13)''')
+  manifest = push_replica(store, source, manifest)
+  assert len(manifest['segments']) == 1
+  assert blobs(store) == sorted([manifest['base'], *manifest['segments'], MANIFEST])
+
+  store.downloaded = []
+  assert pull_replica(store, replica) == manifest
+  assert store.downloaded == [MANIFEST, *manifest['segments']]
+  assert contents(replica) == contents(source)
+  assert get_local_manifest(replica) == manifest
+
+
+def test_nothing_changed_pushes_nothing(store, source):
+  add_dumps(source, 1, 3)
+  manifest = push_replica(store, source, None)
+  before = blobs(store)
+  assert push_replica(store, source, manifest) == manifest
+  assert blobs(store) == before
+
+
+def test_compacts_into_a_new_base(monkeypatch, tmp_path, store, source):
+  monkeypatch.setattr(replicate, 'COMPACT_SEGMENTS', 3)
+  replica = str(tmp_path / 'replica.db')
+  manifest = push_replica(store, source, None)
+  pull_replica(store, replica)
+  first_base = manifest['base']
+  for i in range(3):
+    add_dumps(source, i * 10, 5)
+    manifest = push_replica(store, source, manifest)
+  assert len(manifest['segments']) == 3
+
+  add_dumps(source, 100, 5)
+  manifest = push_replica(store, source, manifest)
+  assert manifest['base'] != first_base and manifest['segments'] == []
+  # the old base and its segments are gone
+  assert blobs(store) == sorted([manifest['base'], MANIFEST])
+
+  store.downloaded = []
+  pull_replica(store, replica)
+  assert store.downloaded == [MANIFEST, manifest['base']]
+  assert contents(replica) == contents(source)
+
+
+def test_rebase_after_vacuum(tmp_path, store, source):
+  replica = str(tmp_path / 'replica.db')
+  add_dumps(source, 1, 5)
+  manifest = push_replica(store, source, None)
+  add_dumps(source, 6, 5)
+  write(source, '''DELETE FROM dumps WHERE id < 4''')
+  conn = sqlite3.connect(source)
+  set_state(conn.cursor(), 'rebase_replica', 1)
+  conn.commit()
+  conn.execute('''VACUUM''')
+  conn.close()
+
+  manifest = push_replica(store, source, manifest)
+  assert manifest['segments'] == []
+  conn = sqlite3.connect(source)
+  assert get_state(conn.cursor(), 'rebase_replica') is None
+  conn.close()
+  pull_replica(store, replica)
+  assert contents(replica) == contents(source)
+
+
+def test_stale_local_db_is_restored(tmp_path, store, source):
+  replica = str(tmp_path / 'replica.db')
+  add_dumps(source, 1, 5)
+  manifest = push_replica(store, source, None)
+  pull_replica(store, replica)
+
+  # written to locally without being pushed, so it no longer matches
+  set_local_manifest(replica, None)
+  write(replica, '''DELETE FROM dumps''')
+  add_dumps(source, 6, 5)
+  manifest = push_replica(store, source, manifest)
+  store.downloaded = []
+  pull_replica(store, replica)
+  assert store.downloaded == [MANIFEST, manifest['base'], *manifest['segments']]
+  assert contents(replica) == contents(source)
+
+
+def test_manifest_of_another_base_is_restored(tmp_path, store, source):
+  replica = str(tmp_path / 'replica.db')
+  add_dumps(source, 1, 5)
+  manifest = push_replica(store, source, None)
+  pull_replica(store, replica)
+  # the replica was rebased since this copy was pulled
+  set_local_manifest(replica, dict(manifest, base='base-99999999.db',
+    segments=['segment-99999999.db']))
+  add_dumps(source, 6, 5)
+  manifest = push_replica(store, source, manifest)
+
+  store.downloaded = []
+  pull_replica(store, replica)
+  assert store.downloaded == [MANIFEST, manifest['base'], *manifest['segments']]
+  assert contents(replica) == contents(source)
+
+
+def test_no_replica_to_pull(tmp_path, store):
+  assert pull_replica(store, str(tmp_path / 'replica.db')) is None
+
+
+def test_restore_replica_matches_source(monkeypatch, tmp_path, store, source):
+  restored = str(tmp_path / 'restored.db')
+  monkeypatch.setattr(replicate, 'DBNAME', restored)
+  monkeypatch.setattr(replicate, 'get_store', lambda: store)
+  add_dumps(source, 1, 10)
+  manifest = push_replica(store, source, None)
+  add_dumps(source, 11, 10)
+  write(source,
+      '''UPDATE dumps SET body = 'changed' WHERE id = 5''',
+      '''DELETE FROM dumps WHERE id = 15''')
+  push_replica(store, source, manifest)
+
+  restore_replica(argparse.Namespace(force=False, dry_run=False))
+  assert contents(restored) == contents(source)
+
+  # forced, even over a copy that claims to be current
+  write(restored, '''DELETE FROM dumps''')
+  restore_replica(argparse.Namespace(force=True, dry_run=False))
+  assert contents(restored) == contents(source)
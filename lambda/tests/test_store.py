@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+import pytest
+
+import store
+from store import (LocalStore, download_cached, upload_cached,
+    get_cached_generation, set_cached_generation)
+
+
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+  '''LocalStore counting the blobs it copies out in `bucket.copies`'''
+  os.mkdir(tmp_path / 'store')
+  bucket = LocalStore(str(tmp_path / 'store'))
+  bucket.copies = 0
+  copyfile = store.shutil.copyfile
+  def counting_copyfile(src, dst):
+    if src.startswith(bucket.root + os.sep):
+      bucket.copies += 1
+    return copyfile(src, dst)
+  monkeypatch.setattr(store.shutil, 'copyfile', counting_copyfile)
+  return bucket
+
+
+def put(bucket, tmp_path, name, data):
+  src = tmp_path / 'upload'
+  src.write_text(data)
+  return bucket.upload(str(src), name)
+
+
+def read(path):
+  with open(path) as f:
+    return f.read()
+
+
+def test_unchanged_generation_skips_download(tmp_path, bucket):
+  path = str(tmp_path / 'dumps.db')
+  generation = put(bucket, tmp_path, 'dumps.db', 'v1')
+  assert download_cached(bucket, 'dumps.db', path) == generation
+  assert bucket.copies == 1 and read(path) == 'v1'
+  assert get_cached_generation(path) == generation
+
+  # a warm instance still holding it
+  assert download_cached(bucket, 'dumps.db', path) == generation
+  assert bucket.copies == 1
+
+
+def test_changed_generation_replaces_file(tmp_path, bucket):
+  path = str(tmp_path / 'dumps.db')
+  first = put(bucket, tmp_path, 'dumps.db', 'v1')
+  download_cached(bucket, 'dumps.db', path)
+  # uploaded by another instance since, as quickly as the filesystem allows
+  second = put(bucket, tmp_path, 'dumps.db', 'v2')
+  assert second != first
+  assert download_cached(bucket, 'dumps.db', path) == second
+  assert bucket.copies == 2 and read(path) == 'v2'
+  assert get_cached_generation(path) == second
+
+
+def test_diverged_copy_is_downloaded_again(tmp_path, bucket):
+  path = str(tmp_path / 'dumps.db')
+  put(bucket, tmp_path, 'dumps.db', 'v1')
+  download_cached(bucket, 'dumps.db', path)
+  # written to by a run that never uploaded it
+  set_cached_generation(path, None)
+  with open(path, 'w') as f:
+    f.write('local')
+  download_cached(bucket, 'dumps.db', path)
+  assert bucket.copies == 2 and read(path) == 'v1'
+
+  # nor is a generation trusted without the file it was recorded for
+  os.remove(path)
+  download_cached(bucket, 'dumps.db', path)
+  assert bucket.copies == 3 and read(path) == 'v1'
+
+
+def test_stale_wal_is_discarded(tmp_path, bucket):
+  path = str(tmp_path / 'dumps.db')
+  put(bucket, tmp_path, 'dumps.db', 'v1')
+  download_cached(bucket, 'dumps.db', path)
+  for ext in ('-wal', '-shm'):
+    with open(path + ext, 'w') as f:
+      f.write('pages of v1')
+
+  # still current, the WAL belongs to it
+  download_cached(bucket, 'dumps.db', path)
+  assert os.path.exists(path + '-wal') and os.path.exists(path + '-shm')
+
+  put(bucket, tmp_path, 'dumps.db', 'v2')
+  download_cached(bucket, 'dumps.db', path)
+  assert not os.path.exists(path + '-wal') and not os.path.exists(path + '-shm')
+
+
+def test_upload_records_generation(tmp_path, bucket):
+  path = str(tmp_path / 'dumps.db')
+  with open(path, 'w') as f:
+    f.write('v1')
+  generation = upload_cached(bucket, path, 'dumps.db')
+  assert get_cached_generation(path) == generation == bucket.generation('dumps.db')
+  # so the next run on this instance doesn't download what it uploaded
+  download_cached(bucket, 'dumps.db', path)
+  assert bucket.copies == 0
+
+
+def test_missing_blob(tmp_path, bucket):
+  with pytest.raises(FileNotFoundError):
+    download_cached(bucket, 'dumps.db', str(tmp_path / 'dumps.db'))
@@ -1,123 +1,221 @@
 #!/usr/bin/env python3
-import requests
-import time
 import json
-import argparse
 import logging as l
 from termcolor import colored
 from datetime import datetime as dt
 from datetime import timedelta
-from bs4 import BeautifulSoup
-from sheetfu import SpreadsheetApp, Table
-from sheets import get_google_sheet, get_apartments_from_google_sheets
-from schema import Dump, Notification, NotificationAction, get_db
+from concurrent.futures import ProcessPoolExecutor
+from sheets import get_apartments_from_google_sheets
+from schema import Dump, get_db, store_body, insert_observations, reset_price_history, LATEST_DUMPS_SQL
+from notify import diff_units, queue_notifications, dispatch_notifications, EMAIL_RECIPIENTS
+import metrics
 
 
-HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 12_3_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.3 Safari/605.1.15'
-    }
 PULL_INTERVAL = 3600
-THROTTLE_TIME = 1
+REEXTRACT_CHUNK = 256
 
 
-def get_updated_dump(a, dumps_by_url):
-  '''get a new dump for apartment `a` if outdated'''
+def is_due(a, last):
+  '''check if apartment `a` with latest dump `last` is outdated'''
   cur_ts = dt.now().timestamp()
-  delta = (timedelta(seconds=int(cur_ts - dumps_by_url[a['url']].timestamp))
-      if a['url'] in dumps_by_url else 0)
+  delta = (timedelta(seconds=int(cur_ts - (last.last_seen or last.timestamp)))
+      if last else 0)
 
   if not delta or delta.total_seconds() > PULL_INTERVAL:
     l.info(f"Pulling data for: {colored(a['name'], 'green')} after {str(delta)}")
-    r = requests.get(a['url'], headers=HEADERS)
-    d = Dump(0, a['url'], dt.now().timestamp(), r.status_code, r.text, None)
-    return d
-
+    return True
   else:
     l.info(f"Skipping {colored(a['name'], 'green')}: Last pulled {str(delta)} ago")
-    return None
+    return False
+
+
+def get_updated_dump(fetcher, a, last):
+  '''get a new dump for apartment `a`'''
+  # let the server tell us if nothing changed since the last dump
+  headers = {}
+  if last and last.etag:
+    headers['If-None-Match'] = last.etag
+  if last and last.last_modified:
+    headers['If-Modified-Since'] = last.last_modified
+
+  r = fetcher.get(a['url'], headers=headers)
+  return Dump(0, a['url'], dt.now().timestamp(), r.status_code, r.text, None,
+      etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+
+
+def is_unchanged(d, last):
+  '''check if pulled dump `d` has the same pricing data as dump `last`'''
+  from extract import get_fingerprint
+  if not last or d.status != 200:
+    return False
+  last_fingerprint = last.fingerprint or get_fingerprint(json.loads(last.extracted or 'null'))
+  return d.fingerprint == last_fingerprint
 
 
 def extract_dump(d):
   '''pull important info from page'''
-  # bs = BeautifulSoup(d.body, features='lxml')
-  bs = BeautifulSoup(d.body, features='html.parser')
-  res = []
-  if 'apartments.com' in d.url:
-    models = bs.select('#pricingView > div[data-tab-content-id="bed1"] .pricingGridItem')
-    for m in models:
-      model_name = m.select_one('.priceBedRangeInfo .modelName').text.strip()
-      for u in m.select('.unitContainer'):
-        # remove these tags
-        for s in u.select('.screenReaderOnly'):
-          s.extract()
-
-        res.append({
-          'model': model_name,
-          'unit': u.select_one('.unitColumn').text.strip(),
-          'price': int(u.select_one('.pricingColumn').text.strip()
-            .replace('$', '').replace(',', '')
-            ),
-          'sqft': int(u.select_one('.sqftColumn').text.strip()
-            .replace(',', '')
-            ),
-          'available': u.select_one('.availableColumn').text.strip(),
-          })
-  else:
+  from extract import get_extractor
+  e = get_extractor(d.url)
+  if not e:
     return None
-  return res
+  d.extractor_version = e.version
+  with metrics.timed('parse_seconds', d.url):
+    return e.extract(d.body)
 
 
 def update_dumps(args):
   conn, c = get_db()
   
+  # get apartments from google sheets
+  apmts = get_apartments_from_google_sheets(local=args.local)
+
   # get latest dumps for each url
-  res = c.execute('''
-      SELECT t1.*
-      FROM dumps t1
-      JOIN (
-        SELECT url, max(timestamp) as timestamp
-        FROM dumps t2
-        WHERE status = 200
-        GROUP BY url
-      ) t2 on t1.timestamp = t2.timestamp
-      ''')
+  res = c.execute(LATEST_DUMPS_SQL, (json.dumps([a['url'] for a in apmts]),))
   dumps = [Dump(*r) for r in res]
   dumps_by_url = {d.url: d for d in dumps}
 
-  # get apartments from google sheets
-  apmts = get_apartments_from_google_sheets(local=args.local)
+  # pull pages concurrently, but keep parsing and db writes on this thread
+  notifications = []
+  due = []
   for a in apmts:
-    d = get_updated_dump(a, dumps_by_url)
-    data = None
-    if d:
-      # new dump pulled
-      data = extract_dump(d)
-      d.extracted = json.dumps(data)
-      d.body = ''
+    if is_due(a, dumps_by_url.get(a['url'])):
+      due.append(a)
+    else:
+      notifications += store_updated_dump(args, conn, c, a, None, dumps_by_url)
+
+  if due:
+    # requests and the parser are only loaded when there is something to pull
+    from fetch import Fetcher
+    with metrics.span('pull', urls=len(due)), Fetcher() as fetcher:
+      results = fetcher.map(
+          lambda f, a: get_updated_dump(f, a, dumps_by_url.get(a['url'])), due)
+      for a, d, err in results:
+        if err:
+          l.error(f"Failed to pull {colored(a['name'], 'red')}: {err}")
+          continue
+        notifications += store_updated_dump(args, conn, c, a, d, dumps_by_url)
+
+  if notifications:
+    l.info(f'Found {len(notifications)} changes to notify about')
+  metrics.count('notifications', len(notifications))
+  if not args.dry_run:
+    with metrics.span('smtp'):
+      dispatch_notifications(conn, c)
+
+
+def store_updated_dump(args, conn, c, a, d, dumps_by_url):
+  '''extract and save dump `d` if newly pulled, log units for apartment `a`.
+  returns notifications for changes since the last dump'''
+  data = None
+  notifications = []
+  last = dumps_by_url.get(a['url'])
+  if d and d.status == 304:
+    # not modified, no need to parse the page at all
+    l.info(f"{colored(a['name'], 'green')} not modified since last pull")
+    touch_dump(args, conn, c, last, d)
+    data = json.loads(last.extracted)
+
+  elif d:
+    # new dump pulled
+    from extract import get_fingerprint
+    data = extract_dump(d)
+    d.extracted = json.dumps(data)
+    d.fingerprint = get_fingerprint(data)
 
+    if d.status == 200 and data == []:
+      # a bot wall or changed layout, not every unit being let at once
+      l.error(f"Found no units for {colored(a['name'], 'red')}, skipping the pull")
+      d.body = ''
+      data = json.loads(last.extracted or 'null') if last else None
+    elif is_unchanged(d, last):
+      l.info(f"{colored(a['name'], 'green')} pricing unchanged since last pull")
+      touch_dump(args, conn, c, last, d)
+    else:
+      if d.status == 200 and data is not None:
+        old = json.loads(last.extracted or 'null') if last else []
+        notifications = diff_units(a['name'], old or [], data, d.timestamp)
       if not args.dry_run:
-        d.insert(conn, c)
+        with metrics.timed('db_write_seconds', d.url):
+          # keep the page around compressed, in case it needs reextracting
+          d.body_hash = store_body(c, d.body)
+          d.body = ''
+          d.insert_with_observations(conn, c, data, commit=False)
+          queue_notifications(c, EMAIL_RECIPIENTS, notifications)
+          conn.commit()
+        metrics.count('dumps_inserted')
+        metrics.count('observations_inserted', len(data or []))
       dumps_by_url[d.url] = d
-      time.sleep(THROTTLE_TIME)
-    else:
-      d = dumps_by_url[a['url']]
-      if d.extracted:
-        data = json.loads(d.extracted)
+    d.body = ''
+
+  else:
+    d = dumps_by_url[a['url']]
+    if d.extracted:
+      data = json.loads(d.extracted)
+
+  if data is not None:
+    l.info(f'Found {len(data)} units')
+    for u in data:
+      l.info(f'{json.dumps(u)}')
+  return notifications
 
-    if data is not None:
-      l.info(f'Found {len(data)} units')
-      for u in data:
-        l.info(f'{json.dumps(u)}')
+
+def touch_dump(args, conn, c, last, d):
+  '''extend dump `last` up to the time unchanged dump `d` was pulled'''
+  last.last_seen = d.timestamp
+  last.etag = d.etag or last.etag
+  last.last_modified = d.last_modified or last.last_modified
+  if not args.dry_run:
+    last.touch(conn, c)
+    metrics.count('dumps_touched')
 
 
 def reextract_dumps(args):
+  '''re-run extractors over stored page bodies, by default only for dumps
+  extracted by an older version of their extractor'''
+  from extract import get_extractor, extract_row
   conn, c = get_db()
 
-  res = c.execute('''SELECT * FROM dumps''').fetchall()
-  for r in res:
-    d = Dump(*r)
-    data = extract_dump(d)
-    c.execute('''UPDATE dumps SET extracted = ? WHERE id = ?''',
-        (json.dumps(data), d.id))
-  conn.commit()
-  l.info(f'Re-extracted {len(res)} dumps!')
+  # current extractor version for each url, compared against in sql
+  c.execute('''CREATE TEMP TABLE extractor_versions (url TEXT PRIMARY KEY, version INTEGER)''')
+  urls = [r[0] for r in c.execute('''SELECT DISTINCT url FROM dumps''').fetchall()]
+  c.executemany('''INSERT INTO extractor_versions VALUES (?, ?)''', [
+    (url, get_extractor(url).version) for url in urls if get_extractor(url)])
+
+  # page through with a keyset instead of holding a cursor open over writes
+  n, last_id = 0, -1
+  with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+    while True:
+      rows = c.execute('''
+          SELECT d.id, d.url, d.body, b.codec, b.data, d.timestamp, d.status
+          FROM dumps d
+          JOIN extractor_versions v ON d.url = v.url
+          LEFT JOIN bodies b ON d.body_hash = b.hash
+          WHERE d.id > ? AND (d.body != '' OR b.hash IS NOT NULL)
+            AND (? OR d.extractor_version IS NULL OR d.extractor_version < v.version)
+          ORDER BY d.id
+          LIMIT ?
+          ''', (last_id, args.force, REEXTRACT_CHUNK)).fetchall()
+      if not rows:
+        break
+      last_id = rows[-1][0]
+
+      res = list(ex.map(extract_row, [r[:5] for r in rows], chunksize=16))
+      if not args.dry_run:
+        c.executemany('''
+            UPDATE dumps SET extracted = ?, fingerprint = ?, extractor_version = ?
+            WHERE id = ?
+            ''', res)
+        c.executemany('''DELETE FROM observations WHERE dump_id = ?''',
+            [(r[0],) for r in rows])
+        for (extracted, _, _, id), r in zip(res, rows):
+          insert_observations(c, id, r[1], r[5], r[6], json.loads(extracted))
+        conn.commit()
+      n += len(res)
+      l.info(f'Re-extracted {n} dumps...')
+
+  c.execute('''DROP TABLE extractor_versions''')
+  if n and not args.dry_run:
+    # old prices may have changed
+    reset_price_history(c)
+    conn.commit()
+  l.info(f'Re-extracted {n} dumps!')